@@ -8,19 +8,36 @@
 #
 # See README.md for more information.
 
+import cPickle
+import cProfile
+import datetime
+import gc
+import hashlib
+import json
+import httplib
 import logging
+import multiprocessing
 import optparse
 import os
 import plistlib
+import pstats
+import random
 import re
+import socket
 import sqlite3
 import subprocess
 import sys
+import threading
+import time
 import urllib
+import urllib2
 import zipfile
+import BaseHTTPServer
+import SocketServer
 
-from collections import namedtuple
-from urlparse import urljoin
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+from urlparse import urljoin, urlparse
 from xml.etree import ElementTree as ET
 from xml.parsers.expat import ExpatError
 
@@ -30,14 +47,26 @@ DEFAULT_PREFS = {
     'munki_repo_destination_path': 'apps/Adobe/CC_Updates',
     'munkiimport_options': [],
     'local_cache_path': os.path.join(SCRIPT_DIR, 'aamcache'),
-    'munki_tool': 'munkiimport'
+    'munki_tool': 'munkiimport',
+    'feed_max_age': 0,
+    'details_negative_ttl': 86400,
+    'details_fetch_concurrency': 8,
+    'download_concurrency': 4,
+    'import_concurrency': 4,
+    'cache_max_size': 0,
+    'cache_max_age': 0,
+    'cache_layout': 'flat'
 }
 settings_plist = os.path.join(SCRIPT_DIR, 'aamporter.plist')
 supported_settings_keys = DEFAULT_PREFS.keys()
 supported_settings_keys.append('aam_server_baseurl')
-UpdateMeta = namedtuple('update', ['channel', 'product', 'version', 'revoked', 'xml'])
+UpdateMeta = namedtuple('update', ['channel', 'product', 'version', 'revoked', 'details'])
 UPDATE_PATH_PREFIX = 'updates/oobe/aam20/'
 MUNKI_DIR = '/usr/local/munki'
+MUNKI_TOOLS = ('munkiimport', 'makepkginfo')
+# 'content' stores each payload once under blobs/sha256 in the cache, and
+# links the usual <product>-<version> names to it
+CACHE_LAYOUTS = ('flat', 'content')
 ERROR = 50
 WARNING = 40
 INFO = 30
@@ -45,6 +74,11 @@ VERBOSE = 20
 DEBUG = 10
 
 NONSSL_ADOBE_URL = False
+FEED_CHUNK_SIZE = 64 * 1024
+HTTP_TIMEOUT = 60
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+HASH_SIDECAR_SUFFIX = '.sha256.plist'
+_http_local = threading.local()
 
 class ColorFormatter(logging.Formatter):
     # http://ascii-table.com/ansi-escape-sequences.php
@@ -83,23 +117,213 @@ def errorExit(err_string, err_code=1):
     sys.exit(err_code)
 
 
-def pref(name):
-    p = {}
-    if os.path.exists(settings_plist):
+class SettingsError(Exception):
+    """Raised when the settings plist can't be parsed or is invalid."""
+    pass
+
+
+class Settings(object):
+    """Settings from the aamporter.plist at path, falling back to DEFAULT_PREFS.
+
+    The plist is parsed and validated once, on first use, raising
+    SettingsError if it is invalid, and is only parsed again by
+    reloadIfChanged() if its modification time changed since it was last
+    loaded successfully."""
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.values = None
+
+    def _mtime(self):
         try:
-            p = plistlib.readPlist(settings_plist)
-        except ExpatError:
-            errorExit(
-                "Settings plist found at %s, but it could not be parsed!"
-                % settings_plist)
-
-    if name in DEFAULT_PREFS.keys() and not name in p.keys():
-        value = DEFAULT_PREFS[name]
-    elif name in p.keys():
-        value = p[name]
-    else:
-        value = None
-    return value
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def load(self):
+        mtime = self._mtime()
+        values = {}
+        if mtime is not None:
+            try:
+                values = plistlib.readPlist(self.path)
+            except ExpatError:
+                raise SettingsError(
+                    "Settings plist found at %s, but it could not be parsed!"
+                    % self.path)
+        for k in values.keys():
+            if k not in supported_settings_keys:
+                L.log(WARNING, "Warning: Unknown setting in %s: %s" % (os.path.basename(self.path), k))
+        munki_tool = values.get('munki_tool', DEFAULT_PREFS['munki_tool'])
+        if munki_tool not in MUNKI_TOOLS:
+            raise SettingsError("Not sure what tool you wanted to use; munki_tool should be 'munkiimport' "
+                      "or 'makepkginfo' but we got '%s'." % munki_tool)
+        cache_layout = values.get('cache_layout', DEFAULT_PREFS['cache_layout'])
+        if cache_layout not in CACHE_LAYOUTS:
+            raise SettingsError("cache_layout should be 'flat' or 'content' but we got '%s'." % cache_layout)
+        self.values = values
+        self.mtime = mtime
+
+    def reloadIfChanged(self):
+        """Reload the settings if the plist was modified, created or removed
+        since it was last loaded. Returns True if they were reloaded.
+
+        If settings were loaded before and the changed plist is invalid, the
+        previous settings are kept, with a warning, and the plist is tried
+        again on the next call."""
+        if self.values is not None and self._mtime() == self.mtime:
+            return False
+        if self.values is None:
+            self.load()
+            return True
+        try:
+            self.load()
+        except SettingsError as e:
+            L.log(WARNING, "Warning: %s Using the previously loaded settings, and reading "
+                  "it again on the next run." % e)
+            return False
+        return True
+
+    def get(self, name):
+        if self.values is None:
+            self.load()
+        if name in self.values:
+            return self.values[name]
+        return DEFAULT_PREFS.get(name)
+
+
+settings = Settings(settings_plist)
+
+
+def pref(name):
+    return settings.get(name)
+
+
+class RunStats(object):
+    """Timings and counters collected over a run, for --stats-json and
+    --stats-prom.
+
+    - phases: phase name -> seconds spent in it, in the order they ran
+    - counters: name -> count, such as requests made or bytes downloaded
+    - histograms: name -> latencies in seconds of individual operations,
+      bucketed by BUCKETS
+
+    Counters and histograms may be updated from worker threads."""
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        self.result = None
+        self.phases = OrderedDict()
+        self.current_phase = None
+        self.phase_started = None
+        self.counters = {}
+        self.histograms = {}
+
+    def startPhase(self, name):
+        """Starts timing a phase of the run, ending the current one."""
+        self.endPhase()
+        self.current_phase = name
+        self.phase_started = time.time()
+
+    def endPhase(self):
+        if self.current_phase is not None:
+            self.phases[self.current_phase] = (self.phases.get(self.current_phase, 0) +
+                                               time.time() - self.phase_started)
+            self.current_phase = None
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        """Records the latency of a single operation in histogram 'name'."""
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                name, {'buckets': [0] * len(self.BUCKETS), 'count': 0, 'sum': 0.0})
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    def finish(self, result):
+        self.endPhase()
+        self.finished = time.time()
+        self.result = result
+
+    def asDict(self):
+        histograms = {}
+        for name, histogram in self.histograms.items():
+            histograms[name] = {
+                'count': histogram['count'],
+                'sum': histogram['sum'],
+                'buckets': OrderedDict(
+                    (str(bound), n) for bound, n in zip(self.BUCKETS, histogram['buckets']))}
+        return OrderedDict([
+            ('started', self.started),
+            ('finished', self.finished),
+            ('duration', (self.finished or time.time()) - self.started),
+            ('result', self.result),
+            ('phases', self.phases),
+            ('counters', self.counters),
+            ('histograms', histograms)])
+
+    def writeJSON(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.asDict(), f, indent=2)
+        os.rename(tmp_path, path)
+
+    def writePrometheus(self, path):
+        """Writes the stats in the Prometheus text format, for the node
+        exporter's textfile collector, which requires the file to be
+        replaced atomically.
+
+        Every value is the last run's, and starts again from zero in the
+        next one, so all of them are gauges named aamporter_last_run_*:
+        exporting them as counters or histograms would have Prometheus see
+        each new run as a counter reset."""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP aamporter_%s %s' % (name, help_text))
+            lines.append('# TYPE aamporter_%s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('aamporter_%s%s %s' % (name, labels, repr(float(value))))
+
+        metric('last_run_timestamp_seconds', 'gauge', 'Time the last run finished.',
+               [('', self.finished or time.time())])
+        metric('last_run_duration_seconds', 'gauge', 'Duration of the last run.',
+               [('', self.asDict()['duration'])])
+        metric('last_run_success', 'gauge', 'Whether the last run succeeded.',
+               [('', self.result == 'success')])
+        metric('last_run_phase_duration_seconds', 'gauge', 'Seconds spent in each phase of the last run.',
+               [('{phase="%s"}' % name, seconds) for name, seconds in self.phases.items()])
+        for name, value in sorted(self.counters.items()):
+            metric('last_run_' + name, 'gauge', 'Count of %s in the last run.' % name.replace('_', ' '),
+                   [('', value)])
+        for name, histogram in sorted(self.histograms.items()):
+            description = name.replace('_', ' ')
+            buckets = [('{le="%s"}' % bound, n) for bound, n in zip(self.BUCKETS, histogram['buckets'])]
+            buckets.append(('{le="+Inf"}', histogram['count']))
+            metric('last_run_%s_seconds_bucket' % name, 'gauge',
+                   'Number of %s operations in the last run that took at most le seconds.' % description,
+                   buckets)
+            metric('last_run_%s_seconds_sum' % name, 'gauge',
+                   'Total seconds taken by %s operations in the last run.' % description,
+                   [('', histogram['sum'])])
+            metric('last_run_%s_count' % name, 'gauge',
+                   'Number of %s operations in the last run.' % description,
+                   [('', histogram['count'])])
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, path)
+
+
+stats = RunStats()
 
 
 def getURL(type='updates'):
@@ -116,23 +340,140 @@ def getURL(type='updates'):
         return urls[1]
 
 
-def getFeedData(platform):
+def iterFeedTokens(fileobj, chunk_size=FEED_CHUNK_SIZE):
+    """Generator yielding the contents of each <...> entry in the feed as it is
+    read from fileobj in chunks of chunk_size bytes. Entries never span lines,
+    so only complete lines are tokenized and any partial trailing line is held
+    over until the next chunk arrives."""
+    search = re.compile("<(.+?)>")
+    pending = ''
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        line_end = pending.rfind('\n')
+        if line_end == -1:
+            continue
+        for token in search.findall(pending, 0, line_end):
+            yield token
+        pending = pending[line_end + 1:]
+    for token in search.findall(pending):
+        yield token
+
+
+def getFeedCachePaths(platform):
+    """Returns the paths of the cached copy of the updater feed for platform
+    and of the plist recording its ETag, Last-Modified and last check time."""
+    feed_dir = os.path.join(pref('local_cache_path'), 'feeds', platform)
+    return (os.path.join(feed_dir, 'updaterfeed.xml'),
+            os.path.join(feed_dir, 'updaterfeed.plist'))
+
+
+def readCachedFeed(feed_path):
+    """Generator yielding the raw entries of a cached copy of the feed."""
+    with open(feed_path, 'rb') as feed_file:
+        for token in iterFeedTokens(feed_file):
+            yield token
+
+
+def cacheFeedResponse(response, url, feed_path, meta_path):
+    """Generator yielding the raw entries of the feed from an HTTP response
+    while writing it alongside to the feed cache. The cached copy and its
+    validators only replace the previous ones once the whole feed was read."""
+    feed_dir = os.path.dirname(feed_path)
+    if not os.path.isdir(feed_dir):
+        os.makedirs(feed_dir)
+    partial_path = feed_path + '.part'
+
+    class TeeReader(object):
+        def __init__(self, source, dest):
+            self.source = source
+            self.dest = dest
+
+        def read(self, size):
+            chunk = self.source.read(size)
+            self.dest.write(chunk)
+            stats.count('feed_bytes', len(chunk))
+            return chunk
+
+    try:
+        with open(partial_path, 'wb') as partial:
+            for token in iterFeedTokens(TeeReader(response, partial)):
+                yield token
+    except IOError as e:
+        L.log(ERROR, "Error reading feed data from URL: %s" % url)
+        errorExit(e)
+    finally:
+        response.close()
+    os.rename(partial_path, feed_path)
+    meta = {'url': url, 'checked': datetime.datetime.utcnow()}
+    for header, key in (('ETag', 'etag'), ('Last-Modified', 'last_modified')):
+        value = response.info().getheader(header)
+        if value:
+            meta[key] = value
+    plistlib.writePlist(meta, meta_path)
+
+
+def getFeedData(platform, max_age=0):
+    """Returns a generator of the raw <...> entries in the updater feed for
+    platform, tokenized as the feed is read.
+
+    The feed is cached in local_cache_path along with its ETag and
+    Last-Modified headers, which are sent back as a conditional GET so that
+    an unchanged feed is read from the cache. If the cached copy was checked
+    less than max_age seconds ago, the network is skipped entirely."""
     url = urljoin(getURL(type='webfeed'), 'webfeed/oobe/aam20/%s/updaterfeed.xml' % platform)
+    feed_path, meta_path = getFeedCachePaths(platform)
+
+    meta = {}
+    if os.path.exists(feed_path) and os.path.exists(meta_path):
+        try:
+            meta = plistlib.readPlist(meta_path)
+        except ExpatError:
+            L.log(VERBOSE, "Couldn't read cached feed metadata at %s, ignoring it." % meta_path)
+        if meta.get('url') != url:
+            meta = {}
+
+    # a cached copy without a 'checked' time is treated as stale
+    if meta.get('checked') and max_age:
+        age = datetime.datetime.utcnow() - meta['checked']
+        if age < datetime.timedelta(seconds=max_age):
+            L.log(VERBOSE, "Using cached feed data, last checked %d seconds ago." % age.total_seconds())
+            stats.count('feed_cache_hits')
+            return readCachedFeed(feed_path)
+
+    request = urllib2.Request(url)
+    if meta.get('etag'):
+        request.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        request.add_header('If-Modified-Since', meta['last_modified'])
+    stats.count('feed_requests')
+    request_started = time.time()
     try:
-        opener = urllib.urlopen(url)
+        response = urllib2.urlopen(request)
+        stats.observe('feed_request', time.time() - request_started)
+    except urllib2.HTTPError as e:
+        stats.observe('feed_request', time.time() - request_started)
+        if e.code == 304 and meta:
+            L.log(VERBOSE, "Feed data not modified since last check, using cached copy.")
+            stats.count('feed_not_modified')
+            meta['checked'] = datetime.datetime.utcnow()
+            plistlib.writePlist(meta, meta_path)
+            return readCachedFeed(feed_path)
+        L.log(ERROR, "Error reading feed data from URL: %s" % url)
+        errorExit(e)
     except BaseException as e:
         L.log(ERROR, "Error reading feed data from URL: %s" % url)
         errorExit(e)
 
-    xml = opener.read()
-    opener.close()
-    search = re.compile("<(.+?)>")
-    results = re.findall(search, xml)
-    return results
+    return cacheFeedResponse(response, url, feed_path, meta_path)
 
 
 def parseFeedData(feed_list):
-    updates = []
+    """Generator yielding an UpdateMeta tuple for each non-COMBO entry in an
+    iterable of raw feed entries."""
+    debug = L.isEnabledFor(DEBUG)
     for update in feed_list:
         # skip COMBOs (language packs?)
         if not update.startswith('COMBO'):
@@ -144,10 +485,10 @@ def parseFeedData(feed_list):
                 revoked = False
             else:
                 revoked = True
-            L.log(DEBUG, "Parsed: Channel: {0}, Product: {1}, Version: {2}, Revoked: {3}".format(
-                chan, prod, ver, revoked))
-            updates.append(UpdateMeta(channel=chan, product=prod, version=ver, revoked=revoked, xml=None))
-    return updates
+            if debug:
+                L.log(DEBUG, "Parsed: Channel: {0}, Product: {1}, Version: {2}, Revoked: {3}".format(
+                    chan, prod, ver, revoked))
+            yield UpdateMeta(channel=chan, product=prod, version=ver, revoked=revoked, details=None)
 
 
 def getChannelsFromProductPlists(products):
@@ -168,19 +509,328 @@ def getChannelsFromProductPlists(products):
     return channels
 
 
-def getUpdatesForChannel(channel_id, parsed_feed):
-    updates = []
-    for update in parsed_feed:
-        if update.channel == channel_id:
-            updates.append(update)
-    if not len(updates):
-        updates = None
-    return updates
+class FeedIndex(object):
+    """Lookup tables built once from the output of parseFeedData, so that
+    per-channel and per-update questions about the feed don't each require
+    a scan of the entire feed.
+
+    - channels: channel ID -> list of UpdateMeta tuples for that channel
+    - revoke_counts: (channel, product, version) -> net REVOKE count, where
+      each REVOKE line counts +1 and each non-REVOKE line counts -1
+    - highest_versions: product -> highest non-revoked version in the feed
+    """
+    def __init__(self, parsed_feed):
+        self.channels = {}
+        self.revoke_counts = {}
+        for update in parsed_feed:
+            self.channels.setdefault(update.channel, []).append(update)
+            key = (update.channel, update.product, update.version)
+            if update.revoked:
+                self.revoke_counts[key] = self.revoke_counts.get(key, 0) + 1
+            else:
+                self.revoke_counts[key] = self.revoke_counts.get(key, 0) - 1
+        self.highest_versions = getHighestVersionsOfProducts(
+            [u for channel_updates in self.channels.values() for u in channel_updates])
+
+    def revokeCount(self, channel, product, version):
+        """Net REVOKE count for an update, taking into account both lines for
+        the channel itself and 'REVOKE,ALL' lines."""
+        count = self.revoke_counts.get((channel, product, version), 0)
+        if channel != 'ALL':
+            count += self.revoke_counts.get(('ALL', product, version), 0)
+        return count
+
+
+def getUpdatesForChannel(channel_id, feed_index):
+    return feed_index.channels.get(channel_id) or None
+
+
+class UpdateDetails(object):
+    """The fields aamporter uses from an update's details XML. file_name and
+    file_size are None if the XML has no InstallFiles/File element."""
+    __slots__ = ('licensing_type', 'file_name', 'file_size', 'display_name', 'description')
+
+    def __init__(self, licensing_type=None, file_name=None, file_size=None,
+                 display_name=None, description=None):
+        self.licensing_type = licensing_type
+        self.file_name = file_name
+        self.file_size = file_size
+        self.display_name = display_name
+        self.description = description
+
+    def __repr__(self):
+        return 'UpdateDetails(%s)' % ', '.join(
+            '%s=%r' % (f, getattr(self, f)) for f in self.__slots__)
+
+
+class DetailsCache(object):
+    """Persistent SQLite store of the fields aamporter uses from each update's
+    details XML, keyed by platform, product and version.
+
+    Published details XMLs don't change, so successful lookups are kept
+    indefinitely. Updates whose XML was missing or unparseable are recorded
+    as well, and are retried once they are older than negative_ttl seconds.
+    Server and network errors aren't recorded, so they are retried by the
+    next run.
+    """
+    FIELDS = list(UpdateDetails.__slots__)
+
+    def __init__(self, db_path, negative_ttl=86400, shared=False):
+        self.negative_ttl = negative_ttl
+        # a shared cache may be used from several threads, which must take
+        # turns using it
+        self.conn = sqlite3.connect(db_path, check_same_thread=not shared)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS details (
+            platform TEXT, product TEXT, version TEXT, status TEXT,
+            licensing_type TEXT, file_name TEXT, file_size TEXT,
+            display_name TEXT, description TEXT, checked REAL,
+            PRIMARY KEY (platform, product, version))""")
+        self.conn.commit()
+
+    def get(self, platform, product, version):
+        """Returns a tuple of (status, UpdateDetails or None) for a cached
+        update, or None if it isn't cached or its negative result expired."""
+        row = self.conn.execute(
+            "SELECT status, checked, %s FROM details "
+            "WHERE platform = ? AND product = ? AND version = ?" % ', '.join(self.FIELDS),
+            (platform, product, version)).fetchone()
+        if row is None:
+            return None
+        status, checked = row[0], row[1]
+        if status == 'ok':
+            return (status, UpdateDetails(*row[2:]))
+        if time.time() - checked < self.negative_ttl:
+            return (status, None)
+        return None
+
+    def put(self, platform, product, version, status, details=None):
+        """Store an UpdateDetails with status 'ok', or a negative result with
+        any other status and no details."""
+        details = details or UpdateDetails()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO details (platform, product, version, status, checked, %s) "
+            "VALUES (?, ?, ?, ?, ?, %s)" % (', '.join(self.FIELDS), ', '.join('?' * len(self.FIELDS))),
+            [platform, product, version, status, time.time()] + [getattr(details, f) for f in self.FIELDS])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+# paths below the details XML's root element to the UpdateDetails field they
+# are stored in. Only the first InstallFiles/File element is used.
+DETAILS_XML_PATHS = {
+    ('TargetLicensingType',): 'licensing_type',
+    ('DisplayName', 'en_US'): 'display_name',
+    ('Description', 'en_US'): 'description',
+    ('InstallFiles', 'File', 'Name'): 'file_name',
+    ('InstallFiles', 'File', 'Size'): 'file_size',
+}
+
+
+def parseUpdateDetails(source):
+    """Returns an UpdateDetails from an update's details XML, read from
+    source, a filename or file object such as an HTTP response. The XML is
+    parsed incrementally and each element discarded once read, so no tree is
+    kept."""
+    details = UpdateDetails()
+    path = []
+    seen_file = False
+    root = None
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            else:
+                path.append(elem.tag)
+            continue
+        if elem is root:
+            break
+        field = DETAILS_XML_PATHS.get(tuple(path))
+        if field and not (seen_file and path[0] == 'InstallFiles'):
+            if getattr(details, field) is None:
+                setattr(details, field, elem.text or '')
+        if path == ['InstallFiles', 'File']:
+            seen_file = True
+        path.pop()
+        elem.clear()
+        if not path:
+            root.clear()
+    return details
+
+
+def formatUpdateDetails(details):
+    """Returns a details XML document holding the fields of an UpdateDetails,
+    which parseUpdateDetails reads back to the same values. Used to serve
+    details to other aamporter instances in --serve mode."""
+    root = ET.Element('UpdateDetails')
+    for path, field in sorted(DETAILS_XML_PATHS.items()):
+        value = getattr(details, field)
+        if value is None:
+            continue
+        parent = root
+        for tag in path:
+            elem = parent.find(tag)
+            if elem is None:
+                elem = ET.SubElement(parent, tag)
+            parent = elem
+        parent.text = value
+    return ET.tostring(root, 'utf-8')
+
+
+def _openHTTPConnection(scheme, host):
+    """Returns a new httplib connection to host, going through a proxy
+    configured in the environment if there is one for scheme."""
+    if scheme == 'https':
+        conn_class = httplib.HTTPSConnection
+    else:
+        conn_class = httplib.HTTPConnection
+    proxy = urllib.getproxies().get(scheme)
+    if not proxy or urllib.proxy_bypass(host.split(':')[0]):
+        return conn_class(host, timeout=HTTP_TIMEOUT), False
+    proxy_host = urlparse(proxy).netloc or proxy
+    if scheme == 'https':
+        conn = conn_class(proxy_host, timeout=HTTP_TIMEOUT)
+        conn.set_tunnel(host)
+        return conn, False
+    return httplib.HTTPConnection(proxy_host, timeout=HTTP_TIMEOUT), True
+
+
+def httpRequest(url, headers=None, max_redirects=5):
+    """Issues a GET for url over a keep-alive connection that is kept per
+    thread and per host, following redirects. Returns the httplib response,
+    which must be read to the end before the thread makes another request
+    to the same host."""
+    if not hasattr(_http_local, 'connections'):
+        _http_local.connections = {}
+    connections = _http_local.connections
+    for _ in range(max_redirects + 1):
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        request_path = parsed.path or '/'
+        if parsed.query:
+            request_path += '?' + parsed.query
+        for attempt in (1, 2):
+            reused = key in connections
+            if not reused:
+                connections[key] = _openHTTPConnection(*key)
+                stats.count('http_connections')
+            conn, absolute_uri = connections[key]
+            try:
+                conn.request('GET', url if absolute_uri else request_path, headers=headers or {})
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                # a kept-alive connection may have been closed by the server,
+                # so retry once on a fresh one
+                conn.close()
+                del connections[key]
+                if not reused or attempt == 2:
+                    raise
+                stats.count('http_retries')
+        if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+            response.read()
+            url = urljoin(url, response.getheader('Location'))
+            stats.count('http_redirects')
+            continue
+        return response
+    raise httplib.HTTPException("Too many redirects for %s" % url)
+
+
+def downloadUpdateDetails(product, version, platform):
+    """Downloads and parses the details XML for an update. Returns a tuple of
+    (status, UpdateDetails), where status is 'ok', or a description of why
+    the details couldn't be used. status is None for errors worth retrying,
+    such as network failures, server errors and rate limiting; only a
+    missing (404 or 410) or unparseable XML is worth caching as a failure."""
+    details_url = urljoin(getURL('updates'), UPDATE_PATH_PREFIX + platform) + \
+    '/%s/%s/%s.xml' % (product, version, version)
+    stats.count('details_requests')
+    request_started = time.time()
+    try:
+        response = httpRequest(details_url)
+        if response.status != 200:
+            response.read()
+            stats.observe('details_request', time.time() - request_started)
+            L.log(DEBUG, "Couldn't read details XML at %s" % details_url)
+            L.log(DEBUG, "HTTP status %s" % response.status)
+            if response.status in (404, 410):
+                return ('http_%s' % response.status, None)
+            return (None, None)
+        # parse straight from the response rather than reading it into memory
+        try:
+            details = parseUpdateDetails(response)
+        finally:
+            # drain the rest of the response so the connection can be reused
+            response.read()
+            stats.observe('details_request', time.time() - request_started)
+    except ET.ParseError as e:
+        L.log(DEBUG, "Couldn't parse XML: %s" % e)
+        return ('parse_error', None)
+    except BaseException as e:
+        L.log(DEBUG, "Couldn't read details XML at %s" % details_url)
+        L.log(DEBUG, e)
+        return (None, None)
+    return ('ok', details)
+
+
+def getUpdateDetails(product, version, platform, details_cache=None):
+    """Returns the UpdateDetails for an update, from details_cache if it's
+    there or else from the update's details XML. Returns None if the details
+    could not be retrieved."""
+    return fetchUpdateDetails([(product, version)], platform, details_cache, workers=1).get(
+        (product, version))
+
+
+def fetchUpdateDetails(keys, platform, details_cache=None, workers=1):
+    """Returns a dict mapping each unique (product, version) tuple in keys to
+    its UpdateDetails, or to None if the details could not be retrieved.
+
+    Updates not found in details_cache are each fetched exactly once, using
+    a pool of up to 'workers' threads, and the results stored back in
+    details_cache."""
+    results = {}
+    to_fetch = []
+    for key in set(keys):
+        cached = details_cache.get(platform, *key) if details_cache else None
+        stats.count('details_cache_hits' if cached else 'details_cache_misses')
+        if cached:
+            status, details = cached
+            if status != 'ok':
+                L.log(DEBUG, "Cached details lookup for %s %s previously failed (%s)" % (
+                    key[0], key[1], status))
+            results[key] = details
+        else:
+            to_fetch.append(key)
+    if not to_fetch:
+        return results
+
+    L.log(VERBOSE, "Fetching details for %s updates.." % len(to_fetch))
+    fetch = lambda key: downloadUpdateDetails(key[0], key[1], platform)
+    if workers > 1 and len(to_fetch) > 1:
+        pool = ThreadPool(min(workers, len(to_fetch)))
+        try:
+            fetched = pool.map(fetch, to_fetch)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        fetched = map(fetch, to_fetch)
+
+    for key, (status, details) in zip(to_fetch, fetched):
+        results[key] = details
+        if details_cache and status is not None:
+            details_cache.put(platform, key[0], key[1], status, details)
+    return results
 
 
-def addUpdatesXML(updates, platform, skipTargetLicensingCC=True):
-    """Takes a list of UpdateMeta objects and adds an ElementTree object
-    with the root of the contents of the update's metadata XML.
+def addUpdatesXML(updates, platform, skipTargetLicensingCC=True, details_cache=None,
+                  details=None):
+    """Takes a list of UpdateMeta objects and adds an UpdateDetails with the
+    fields used from the update's metadata XML. If details_cache
+    is given, metadata is looked up there first and fetched results are
+    stored in it. details may be a dict already returned by
+    fetchUpdateDetails, in which case its results are used as-is.
 
     Also, when skipTargetLicensingCC is True, remove any updates
     with TargetLicensingType of '1'. Further explanation:
@@ -199,43 +849,29 @@ def addUpdatesXML(updates, platform, skipTargetLicensingCC=True):
     At this point, we're skipping them but we need have another mechanism to
     properly discern which can be installed.
     """
+    if details is None:
+        details = {}
     new_updates = []
     for update in updates:
-        details_url = urljoin(getURL('updates'), UPDATE_PATH_PREFIX + platform) + \
-        '/%s/%s/%s.xml' % (update.product, update.version, update.version)
-        try:
-            channel_xml = urllib.urlopen(details_url)
-        except BaseException as e:
-            L.log(DEBUG, "Couldn't read details XML at %s" % details_url)
-            L.log(DEBUG, e)
-            continue
-
-        try:
-            details_xml = ET.fromstring(channel_xml.read())
-        except ET.ParseError as e:
-            L.log(DEBUG, "Couldn't parse XML: %s" % e)
+        key = (update.product, update.version)
+        if key in details:
+            update_details = details[key]
+        else:
+            update_details = getUpdateDetails(update.product, update.version, platform, details_cache)
+        if update_details is None:
             continue
 
         if skipTargetLicensingCC:
-            licensing_type_elem = details_xml.find('TargetLicensingType')
-            if licensing_type_elem is not None:
-                if licensing_type_elem.text == '1':
-                    L.log(DEBUG, "TargetLicensingType of %s found. This seems to be Creative Cloud updates. "
-                        "Skipping update." % licensing_type_elem.text)
-                    continue
+            if update_details.licensing_type == '1':
+                L.log(DEBUG, "TargetLicensingType of %s found. This seems to be Creative Cloud updates. "
+                    "Skipping update." % update_details.licensing_type)
+                continue
 
-        if details_xml is not None:
-            new_update = UpdateMeta(
-                channel=update.channel,
-                product=update.product,
-                version=update.version,
-                revoked=update.revoked,
-                xml=details_xml)
-            new_updates.append(new_update)
+        new_updates.append(update._replace(details=update_details))
     return new_updates
 
 
-def updateIsRevoked(channel, product, version, parsed_feed):
+def updateIsRevoked(channel, product, version, feed_index):
     """Returns True if an update is considered revoked for a channel.
 
     Deduced revocation logic:
@@ -294,126 +930,295 @@ def updateIsRevoked(channel, product, version, parsed_feed):
     Revoke Update: Removing only this recommentation and not the whole update.
 
     """
-    revoke_count = 0
-    for update in parsed_feed:
-        if (update.product, update.version) == (product, version) \
-            and update.channel in [channel, 'ALL']:
-            if update.revoked == True:
-                L.log(DEBUG, "REVOKE counter +1")
-                revoke_count += 1
-            else:
-                L.log(DEBUG, "REVOKE counter -1")
-                revoke_count -= 1
+    revoke_count = feed_index.revokeCount(channel, product, version)
+    L.log(DEBUG, "REVOKE counter for %s %s in channel %s: %s" % (
+        product, version, channel, revoke_count))
     if revoke_count > -1:
         return True
     else:
         return False
 
 
+VERSION_COMPONENT_RE = re.compile(r'(\d+ | [a-z]+ | \.)', re.VERBOSE)
+_version_keys = {}
+
+
+def versionKey(version):
+    """Returns a sort key for a version string that orders versions the same
+    way distutils' LooseVersion does: the string is split into runs of
+    digits and of letters, and compared component by component, with numbers
+    sorting before strings as they did in Python 2.
+
+    Keys are cached, as the same versions are compared many times per run.
+    The cache is cleared at the start of each run, so that it doesn't grow
+    for as long as --watch mode runs."""
+    try:
+        return _version_keys[version]
+    except KeyError:
+        pass
+    key = []
+    for component in VERSION_COMPONENT_RE.split(version):
+        if component and component != '.':
+            try:
+                key.append((0, int(component)))
+            except ValueError:
+                key.append((1, component))
+    key = tuple(key)
+    _version_keys[version] = key
+    return key
+
+
+def getHighestVersionsOfProducts(updates, include_revoked=False):
+    """Given a list of UpdateMeta tuples, return a dict mapping each product
+    to a string of its highest detected version, computed in a single pass."""
+    highest = {}
+    highest_keys = {}
+    for update in updates:
+        if not include_revoked and not update.revoked:
+            key = versionKey(update.version)
+            # '>=' so that, as with a stable sort, the last of any equal
+            # versions wins
+            if update.product not in highest or key >= highest_keys[update.product]:
+                highest[update.product] = update.version
+                highest_keys[update.product] = key
+    return highest
+
+
 def getHighestVersionOfProduct(updates, product, include_revoked=False):
     """Given a list of UpdateMeta tuples, return a string of the
     highest detected version. We should be able to rely entirely on
     the webfeed revoke logic and not use this, but this helps catch
     at least one edge case: AdobeCSXSInfrastructureCS6_3
     """
-    from distutils.version import LooseVersion
-
-    def compare_versions(a, b):
-        """Internal comparison function for use with sorting"""
-        return cmp(LooseVersion(a), LooseVersion(b))
+    return getHighestVersionsOfProducts(
+        [u for u in updates if u.product == product], include_revoked).get(product)
+
+
+def channelDigest(feed_index, channel):
+    """Returns a digest of everything in the feed that determines which
+    updates are wanted for a channel: its entries and the net REVOKE count of
+    each of its updates, including that of 'REVOKE,ALL' lines."""
+    entries = feed_index.channels.get(channel, [])
+    state = sorted((u.product, u.version, u.revoked,
+                    feed_index.revokeCount(channel, u.product, u.version)) for u in entries)
+    return hashlib.sha1(repr(state)).hexdigest()
+
+
+def resolveWantedUpdates(feed_index, channel):
+    """Returns the set of (product, version) tuples wanted for a channel
+    according to the feed alone: the highest version of each product that
+    isn't revoked. Unlike main(), this doesn't consult update details, so
+    updates that later turn out to have no payload are included."""
+    entries = feed_index.channels.get(channel, [])
+    wanted = set()
+    for product, version in getHighestVersionsOfProducts(entries).items():
+        if not updateIsRevoked(channel, product, version, feed_index):
+            wanted.add((product, version))
+    return wanted
+
+
+class FeedSnapshot(object):
+    """Compact record of the previous run for a platform, saved as
+    snapshots/<platform>.plist in the cache path: a digest of each channel's
+    feed entries (see channelDigest), a digest of each product plist, the
+    updates wanted for each channel, and the options that affect them."""
+    def __init__(self, cache_path, platform):
+        self.path = os.path.join(cache_path, 'snapshots', '%s.plist' % platform)
+        self.data = {}
+        if os.path.exists(self.path):
+            try:
+                self.data = plistlib.readPlist(self.path)
+            except ExpatError:
+                L.log(WARNING, "Warning: Feed snapshot at %s could not be parsed, ignoring it." % self.path)
+
+    def changedChannels(self, channel_digests, plist_channels, plist_digests, options_key):
+        """Returns the set of channels that need processing: those whose feed
+        entries changed since the snapshot and those listed in a product
+        plist that changed. Every channel is returned if there's no
+        snapshot or options_key differs."""
+        if not self.data or self.data.get('options') != options_key:
+            return set(channel_digests.keys())
+        old_channels = self.data.get('channels', {})
+        old_plists = self.data.get('product_plists', {})
+        changed = set(c for c, digest in channel_digests.items() if old_channels.get(c) != digest)
+        for path, digest in plist_digests.items():
+            if old_plists.get(path) != digest:
+                changed.update(plist_channels[path])
+        return changed
+
+    def wanted(self, channel):
+        return set(tuple(item) for item in self.data.get('wanted', {}).get(channel, []))
+
+    def save(self, channel_digests, wanted, plist_digests, options_key, failed_channels=()):
+        """Write a new snapshot. failed_channels are recorded without a
+        digest, so they are processed again by the next incremental run."""
+        feed_dir = os.path.dirname(self.path)
+        if not os.path.isdir(feed_dir):
+            os.makedirs(feed_dir)
+        channels = dict(channel_digests)
+        for channel in failed_channels:
+            channels[channel] = ''
+        data = {'options': options_key,
+                'channels': channels,
+                'product_plists': plist_digests,
+                'wanted': dict((c, sorted(list(item) for item in items)) for c, items in wanted.items())}
+        tmp_path = self.path + '.tmp'
+        plistlib.writePlist(data, tmp_path)
+        os.rename(tmp_path, self.path)
+        self.data = data
+
+
+def reportChanges(snapshot, wanted, feed_index):
+    """Logs the updates that are newly wanted, revoked or superseded compared
+    to the snapshot of the previous run."""
+    new, revoked, superseded = [], [], []
+    for channel in sorted(wanted.keys()):
+        old_wanted = snapshot.wanted(channel)
+        for product, version in sorted(wanted[channel] - old_wanted):
+            new.append("%s %s (channel %s)" % (product, version, channel))
+        for product, version in sorted(old_wanted - wanted[channel]):
+            if updateIsRevoked(channel, product, version, feed_index):
+                revoked.append("%s %s (channel %s)" % (product, version, channel))
+            else:
+                replacements = [v for p, v in wanted[channel] if p == product]
+                if replacements:
+                    superseded.append("%s %s by %s (channel %s)" % (
+                        product, version, replacements[0], channel))
+    if not snapshot.data:
+        L.log(INFO, "No snapshot of a previous run was found, so every wanted update is new.")
+    for title, changes in (("New", new), ("Revoked", revoked), ("Superseded", superseded)):
+        L.log(INFO, "%s updates: %s" % (title, len(changes)))
+        for change in changes:
+            L.log(INFO, "  - %s" % change)
+
+
+class ProductPlistError(Exception):
+    """Raised when a product plist can't be built from an installer."""
+    pass
+
+
+def openReadOnlyDB(db_path):
+    """Returns an sqlite3 connection to the existing database at db_path,
+    for databases on installer volumes.
+
+    Python 2's sqlite3 can't open a database read-only (that needs URI
+    filenames, added in Python 3.4), so the database is opened normally and
+    PRAGMA query_only stops the connection from writing to it. Checking that
+    the file exists first keeps a wrong path from creating an empty one."""
+    if not os.path.isfile(db_path):
+        raise ProductPlistError("Error: No database found at %s" % db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+def getChannelsFromESD(path):
+    """Returns the Channel IDs of the installer ESD mounted at path, from its
+    Media_db.db or, failing that, its *.proxy.xml files."""
+    channels = []
+    for root, dirs, files in os.walk(path):
+        if 'payloads' in dirs and 'Install.app' in dirs:
+            payload_dir = os.path.join(root, 'payloads')
+            break
+    else:
+        return channels
 
-    versions = []
-    for update in updates:
-        if update.product == product:
-            if not include_revoked and not update.revoked:
-                versions.append(update.version)
-    if versions:
-        versions.sort(compare_versions)
-        highest = versions[-1]
-        return highest
+    media_db_path = os.path.join(payload_dir, 'Media_db.db')
+    if os.path.exists(media_db_path):
+        conn = openReadOnlyDB(media_db_path)
+        try:
+            result = conn.execute(
+                """SELECT value from PayloadData where PayloadData.key = 'ChannelID'""").fetchall()
+        finally:
+            conn.close()
+        if result:
+            channels = [i[0] for i in result]
+        else:
+            raise ProductPlistError("Error: No ChannelIds could be retrieved from the Media_db!")
     else:
-        return None
+        # fall back to old method of scraping proxy.xml, not compatible with CC products
+        L.log(WARNING, "Warning: No Media_db.db file found to scrape ChannelIds, "
+              "falling back to using *.proxy.xml files.")
+        from glob import glob
+        proxies = glob(payload_dir + '/*/*.proxy.xml')
+        for proxy in proxies:
+            L.log(INFO, "Found %s" % os.path.basename(proxy))
+            pobj = ET.parse(proxy).getroot()
+            chan = pobj.find('Channel')
+            if chan is not None:
+                channels.append(chan.get('id'))
+    return channels
+
+
+def getChannelsFromCCPXML(source):
+    """Returns the sorted Channel IDs in a CCP package's PkgConfig.xml, read
+    from source, a filename or file object. The XML is parsed incrementally,
+    discarding each Media element once its channels are read."""
+    # XML Structure from which we extract Channel IDs:
+    # - PackageInfo
+    # - - PackageHistories
+    # - - - PackagingHistories
+    # - - - - InstallInfo
+    # - - - - - Medias
+    # - - - - - - Media
+    # - - - - - - - ProdChannelIDList
+    # - - - - - - Media
+    # - - - - - - - ProdChannelIDList
+    # - - - - - - [etc.]
+    #
+    # there may be multiple PackageHistories elements if a package was created
+    # from a pre-existing package (<AAMEE_Workflow>MODIFY_EXISTING</AAMEE_Workflow>)
+    id_set = set()
+    found_history = False
+    path = []
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            continue
+        if path[1:] == ['PackageHistories', 'PackagingHistory']:
+            found_history = True
+        elif path[1:] == ['PackageHistories', 'PackagingHistory', 'InstallInfo',
+                          'Medias', 'Media']:
+            channel_id_list = elem.find('ProdChannelIDList')
+            if channel_id_list is not None:
+                for channel_elem in channel_id_list:
+                    id_set.add(channel_elem.text)
+            elem.clear()
+        path.pop()
+    if not found_history:
+        raise ProductPlistError("Unexpected CCP file structure! (Expected 'PackagingHistory' elements")
+    return sorted(id_set)
 
 
 def buildProductPlist(path, munki_update_for):
+    """Returns a product plist with every Channel ID found in a mounted
+    installer ESD or a .ccp file at path. Raises ProductPlistError if the
+    installer can't be read."""
     plist = {}
     channels = []
 
     # If we were given a mounted installer ESD path..
     if os.path.isdir(path):
-        for root, dirs, files in os.walk(path):
-            if 'payloads' in dirs and 'Install.app' in dirs:
-                payload_dir = os.path.join(root, 'payloads')
-
-                media_db_path = os.path.join(payload_dir, 'Media_db.db')
-                if os.path.exists(media_db_path):
-                    conn = sqlite3.connect(media_db_path)
-                    c = conn.cursor()
-                    c.execute("""SELECT value from PayloadData where PayloadData.key = 'ChannelID'""")
-                    result = c.fetchall()
-                    c.close()
-                    if result:
-                        channels = [i[0] for i in result]
-                    else:
-                        errorExit("Error: No ChannelIds could be retrieved from the Media_db!")
-                else:
-                    # fall back to old method of scraping proxy.xml, not compatible with CC products
-                    L.log(WARNING, "Warning: No Media_db.db file found to scrape ChannelIds, "
-                          "falling back to using *.proxy.xml files.")
-                    from glob import glob
-                    proxies = glob(payload_dir + '/*/*.proxy.xml')
-                    for proxy in proxies:
-                        L.log(INFO, "Found %s" % os.path.basename(proxy))
-                        pobj = ET.parse(proxy).getroot()
-                        chan = pobj.find('Channel')
-                        if chan is not None:
-                            channels.append(chan.get('id'))
+        channels = getChannelsFromESD(path)
 
     # or a .ccp file built with CCP?
     elif path.endswith('.ccp'):
-        if zipfile.is_zipfile(path):
-            with zipfile.ZipFile(path, 'r') as ccp_zip:
-                try:
-                    path = ccp_zip.open('PkgConfig.xml', 'r')
-                except KeyError:
-                    errorExit("Couldn't open XML .ccp file at %s/PkgConfig.xml" % path)
-
-        id_set = set()
         try:
-            xml = ET.parse(path)
+            if zipfile.is_zipfile(path):
+                with zipfile.ZipFile(path, 'r') as ccp_zip:
+                    try:
+                        xml_file = ccp_zip.open('PkgConfig.xml', 'r')
+                    except KeyError:
+                        raise ProductPlistError("Couldn't open XML .ccp file at %s/PkgConfig.xml" % path)
+                    channels = getChannelsFromCCPXML(xml_file)
+            else:
+                channels = getChannelsFromCCPXML(path)
         except ET.ParseError:
-            errorExit("Couldn't parse XML .ccp file at %s" % path)
-
-        # XML Structure from which we extract Channel IDs:
-        # - PackageInfo
-        # - - PackageHistories
-        # - - - PackagingHistories
-        # - - - - InstallInfo
-        # - - - - - Medias
-        # - - - - - - Media
-        # - - - - - - - ProdChannelIDList
-        # - - - - - - Media
-        # - - - - - - - ProdChannelIDList
-        # - - - - - - [etc.]
-        package_info = xml.getroot()
-
-        # there may be multiple PackageHistories elements if a package was created
-        # from a pre-existing package (<AAMEE_Workflow>MODIFY_EXISTING</AAMEE_Workflow>)
-        histories = package_info.findall('PackageHistories/PackagingHistory')
-        if not histories:
-            errorExit("Unexpected CCP file structure! (Expected 'PackagingHistory' elements")
-        media_list = []
-        for hist in histories:
-            media_list.extend(hist.findall('InstallInfo/Medias/Media'))
-        for media in media_list:
-            channel_id_list = media.find('ProdChannelIDList')
-            if channel_id_list is not None:
-                for elem in channel_id_list:
-                    id_set.add(elem.text)
-        channels = sorted(list(id_set))
+            raise ProductPlistError("Couldn't parse XML .ccp file at %s" % path)
 
     else:
-        errorExit("No compatible installer item could be found! See the usage for valid input installer types.")
+        raise ProductPlistError("No compatible installer item could be found! See the usage for "
+                                "valid input installer types.")
 
     plist['channels'] = channels
     if munki_update_for:
@@ -421,147 +1226,1084 @@ def buildProductPlist(path, munki_update_for):
 
     return plist
 
-# http://stackoverflow.com/a/13895723/2626090
-def reporthook(blocknum, blocksize, totalsize):
-    readsofar = blocknum * blocksize
-    if totalsize > 0:
-        percent = readsofar * 1e2 / totalsize
-        s = "\r%5.1f%% %*d / %d" % (
-            percent, len(str(totalsize)), readsofar, totalsize)
-        sys.stderr.write(s)
-        if readsofar >= totalsize: # near the end
-            sys.stderr.write("\n")
-    else: # total size is unknown
-        sys.stderr.write("read %d\n" % (readsofar,))
 
+def expandInstallerPaths(paths):
+    """Returns the installer paths to build product plists from, replacing
+    any directory that directly contains .ccp files with those files. Other
+    directories are taken to be mounted ESD installers."""
+    expanded = []
+    for path in paths:
+        if path.endswith('/'):
+            path = path[0:-1]
+        if os.path.isdir(path):
+            ccps = sorted(f for f in os.listdir(path) if f.endswith('.ccp'))
+            if ccps:
+                expanded.extend(os.path.join(path, f) for f in ccps)
+                continue
+        expanded.append(path)
+    return expanded
+
+
+def _buildProductPlistJob(args):
+    """Pool worker for buildProductPlists. Returns a tuple of (plist, None)
+    or (None, error message)."""
+    path, munki_update_for = args
+    try:
+        return (buildProductPlist(path, munki_update_for), None)
+    except ProductPlistError as e:
+        return (None, "%s: %s" % (path, e))
+    except Exception as e:
+        return (None, "Unexpected error reading %s: %s" % (path, e))
+
+
+def buildProductPlists(paths, munki_update_for, workers=1):
+    """Builds a product plist from each installer in paths, using a pool of
+    up to 'workers' processes. Returns a list of (path, plist, error) tuples
+    in the order of paths, where either plist or error is None."""
+    jobs = [(path, munki_update_for) for path in paths]
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        try:
+            results = pool.map(_buildProductPlistJob, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_buildProductPlistJob, jobs)
+    return [(path, plist, error) for (path, (plist, error)) in zip(paths, results)]
+
+
+def hashFile(path, hasher=None):
+    """Returns the SHA-256 hex digest of the file at path. If hasher is given,
+    the file's contents are fed to it instead and nothing is returned."""
+    return_digest = hasher is None
+    if hasher is None:
+        hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), ''):
+            hasher.update(chunk)
+    if return_digest:
+        return hasher.hexdigest()
+
+
+def writeHashSidecar(path, digest):
+    """Records the SHA-256 digest of the file at path in a sidecar plist next
+    to it, along with the file's size and modification time so that a stale
+    sidecar can be detected."""
+    st = os.stat(path)
+    plistlib.writePlist({'sha256': digest,
+                         'size': st.st_size,
+                         'mtime': st.st_mtime},
+                        path + HASH_SIDECAR_SUFFIX)
+
+
+def getFileHash(path):
+    """Returns the SHA-256 hex digest of the file at path, from its sidecar
+    plist if that still matches the file's size and modification time, and
+    otherwise by reading the file (and then writing a new sidecar)."""
+    sidecar_path = path + HASH_SIDECAR_SUFFIX
+    st = os.stat(path)
+    if os.path.exists(sidecar_path):
+        try:
+            sidecar = plistlib.readPlist(sidecar_path)
+        except ExpatError:
+            sidecar = {}
+        if (sidecar.get('size') == st.st_size and sidecar.get('mtime') == st.st_mtime and
+                sidecar.get('sha256')):
+            return sidecar['sha256']
+    L.log(VERBOSE, "Computing SHA-256 hash of %s.." % path)
+    digest = hashFile(path)
+    writeHashSidecar(path, digest)
+    return digest
+
+
+class CacheManifest(object):
+    """Record of the payloads in local_cache_path, stored as manifest.plist
+    in the cache directory. Entries are keyed by file name and hold the
+    product, version, platform, source url, expected size, sha256 hash, and
+    'downloaded', 'last_used' and 'verified' dates.
+
+    The manifest is written to a temporary file and renamed into place, so
+    an interrupted run never leaves a truncated manifest."""
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.path = os.path.join(cache_path, 'manifest.plist')
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                self.entries = plistlib.readPlist(self.path)
+            except ExpatError:
+                L.log(WARNING, "Warning: Cache manifest at %s could not be parsed, "
+                      "starting a new one." % self.path)
+
+    def localPath(self, filename):
+        return os.path.join(self.cache_path, filename)
+
+    def get(self, filename):
+        return self.entries.get(filename)
+
+    def record(self, filename, **fields):
+        """Add or update the entry for filename. Fields with a value of None
+        are left unchanged."""
+        with self.lock:
+            entry = self.entries.setdefault(filename, {})
+            for key, value in fields.items():
+                if value is not None:
+                    entry[key] = value
+
+    def remove(self, filename):
+        with self.lock:
+            self.entries.pop(filename, None)
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path + '.tmp'
+            plistlib.writePlist(self.entries, tmp_path)
+            os.rename(tmp_path, self.path)
+
+
+def verifyCachedFile(manifest, filename):
+    """Checks a cached file against its manifest entry. Returns a tuple of
+    (filename, problem), where problem is None if the file is intact."""
+    entry = manifest.get(filename)
+    path = manifest.localPath(filename)
+    if not os.path.exists(path):
+        return (filename, "missing")
+    size = os.stat(path).st_size
+    if entry.get('size') is not None and size != entry['size']:
+        return (filename, "size is %s bytes, expected %s" % (size, entry['size']))
+    digest = hashFile(path)
+    if entry.get('sha256') and digest != entry['sha256']:
+        return (filename, "SHA-256 hash is %s, expected %s" % (digest, entry['sha256']))
+    writeHashSidecar(path, digest)
+    manifest.record(filename, sha256=digest, verified=datetime.datetime.utcnow())
+    return (filename, None)
+
+
+def verifyCache(manifest, workers=1):
+    """Verifies every file in the cache manifest in parallel, logging any
+    that are missing or don't match their recorded size or hash. Returns
+    the list of file names that failed verification."""
+    filenames = sorted(manifest.entries.keys())
+    L.log(INFO, "Verifying %s cached files.." % len(filenames))
+    if not filenames:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(filenames))))
+    try:
+        results = pool.map(lambda filename: verifyCachedFile(manifest, filename), filenames)
+    finally:
+        pool.close()
+        pool.join()
+    manifest.save()
+
+    failed = []
+    for filename, problem in results:
+        if problem:
+            L.log(ERROR, "Cached file %s failed verification: %s" % (filename, problem))
+            failed.append(filename)
+        else:
+            L.log(VERBOSE, "Cached file %s verified." % filename)
+    return failed
+
+
+class BlobStore(object):
+    """Content-addressed storage for the 'content' cache_layout. Each payload
+    is stored once, as blobs/sha256/<xx>/<sha256> in the cache directory, and
+    its <product>-<version> names in the cache are hard links to the blob, or
+    symbolic links where hard links can't be made.
+
+    Blobs are found by the file name and size declared in the feed, looked
+    up in the cache manifest, so that a payload already cached under another
+    product, version or platform is linked instead of downloaded again."""
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.path = os.path.join(manifest.cache_path, 'blobs', 'sha256')
+        self.lock = threading.Lock()
+        self.index = None
+
+    def blobPath(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def _buildIndex(self):
+        index = {}
+        for entry in self.manifest.entries.values():
+            if entry.get('url') and entry.get('size') is not None and entry.get('sha256'):
+                file_name = os.path.basename(urlparse(entry['url']).path)
+                index[(file_name, entry['size'])] = entry['sha256']
+        return index
+
+    def find(self, file_name, size):
+        """Returns the SHA-256 digest of a stored blob with the given feed
+        file name and size, or None if there isn't one."""
+        with self.lock:
+            if self.index is None:
+                self.index = self._buildIndex()
+            digest = self.index.get((file_name, size))
+        if digest and os.path.isfile(self.blobPath(digest)):
+            return digest
+        return None
 
-def main():
-    usage = """
+    def link(self, digest, path):
+        """Makes path a link to the blob with the given digest, replacing any
+        file already there."""
+        blob_path = self.blobPath(digest)
+        tmp_path = path + '.link'
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(blob_path, tmp_path)
+        except OSError:
+            os.symlink(os.path.relpath(blob_path, os.path.dirname(path)), tmp_path)
+        os.rename(tmp_path, path)
+
+    def add(self, path, digest, file_name=None, size=None):
+        """Moves the file at path into the store, unless a blob with the same
+        digest is already there, and links path to the blob. If file_name
+        and size are given, the blob can be found by them from then on."""
+        blob_path = self.blobPath(digest)
+        if os.path.islink(path) or self.isStored(path, digest):
+            return
+        if not os.path.isdir(os.path.dirname(blob_path)):
+            try:
+                os.makedirs(os.path.dirname(blob_path))
+            except OSError:
+                # made by another thread in the meantime
+                if not os.path.isdir(os.path.dirname(blob_path)):
+                    raise
+        if os.path.exists(blob_path):
+            stats.count('blob_dedup_bytes', os.stat(path).st_size)
+        else:
+            os.rename(path, blob_path)
+        self.link(digest, path)
+        if file_name is not None:
+            with self.lock:
+                if self.index is not None:
+                    self.index[(file_name, size)] = digest
+
+    def isStored(self, path, digest):
+        """Returns whether path is already a link to the blob with the given
+        digest."""
+        try:
+            return os.path.samefile(path, self.blobPath(digest))
+        except OSError:
+            return False
+
+    def unlinkedBlobs(self):
+        """Returns a list of the paths and sizes of the blobs that no payload
+        in the manifest links to any more."""
+        if not os.path.isdir(self.path):
+            return []
+        # the files that the payloads in the manifest are, through symbolic
+        # links too; blobs with hard links are never unlinked
+        linked = set()
+        for filename in self.manifest.entries.keys():
+            try:
+                st = os.stat(self.manifest.localPath(filename))
+            except OSError:
+                continue
+            linked.add((st.st_dev, st.st_ino))
+        unlinked = []
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for digest in os.listdir(prefix_path):
+                blob_path = os.path.join(prefix_path, digest)
+                st = os.stat(blob_path)
+                if st.st_nlink > 1 or (st.st_dev, st.st_ino) in linked:
+                    continue
+                unlinked.append((blob_path, st.st_size))
+        return unlinked
+
+    def prune(self):
+        """Removes the blobs that no payload in the manifest links to any
+        more. Returns the number of bytes freed."""
+        freed = 0
+        for blob_path, size in self.unlinkedBlobs():
+            L.log(VERBOSE, "Removing blob %s, no cached payload links to it." % os.path.basename(blob_path))
+            os.remove(blob_path)
+            freed += size
+            prefix_path = os.path.dirname(blob_path)
+            if not os.listdir(prefix_path):
+                os.rmdir(prefix_path)
+        return freed
+
+
+class DownloadProgress(object):
+    """Aggregated progress indicator for a set of concurrent downloads,
+    written to stderr on a single line."""
+    def __init__(self, total_files, total_bytes, enabled=True):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.done_files = 0
+        self.done_bytes = 0
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.last_write = 0
+
+    def add(self, nbytes):
+        with self.lock:
+            self.done_bytes += nbytes
+            self._write()
+
+    def fileDone(self):
+        with self.lock:
+            self.done_files += 1
+            self._write(force=True)
+
+    def _write(self, force=False):
+        if not self.enabled:
+            return
+        now = time.time()
+        if not force and now - self.last_write < 0.2:
+            return
+        self.last_write = now
+        percent = 100.0
+        if self.total_bytes:
+            percent = self.done_bytes * 1e2 / self.total_bytes
+        sys.stderr.write("\r%5.1f%% %*d / %d bytes, %d of %d files" % (
+            percent, len(str(self.total_bytes)), self.done_bytes, self.total_bytes,
+            self.done_files, self.total_files))
+        if self.done_files == self.total_files:
+            sys.stderr.write("\n")
 
-%prog [options] path/to/plist [path/to/more/plists..]
-%prog --build-product-plist [path/to/CCP/pkg/file.ccp] [--munki-update-for BaseProductPkginfoName]
 
-The first form will check and cache updates for the channels listed in the product plists
-given as arguments.
+def downloadFile(job, progress):
+    """Downloads a single update payload described by the job dict to
+    job['local_path'], reporting bytes read to progress. Returns an error
+    string, or None on success.
+
+    Data is written to a '.part' file next to local_path, which is resumed
+    with a Range request if one is left over from an earlier attempt, and
+    is only renamed to local_path once it has the expected size. If the
+    server can't resume from that point, the '.part' file is discarded and
+    the download started again from the beginning. The file's SHA-256 hash
+    is computed as it is written, and saved to a sidecar (see
+    writeHashSidecar)."""
+    local_path = job['local_path']
+    partial_path = local_path + '.part'
+    try:
+        if os.path.islink(local_path) or (os.path.exists(local_path) and
+                                          os.stat(local_path).st_nlink > 1):
+            # a link to a blob of the 'content' cache_layout, which would be
+            # corrupted for every other name linked to it by resuming into it
+            os.remove(local_path)
+        elif os.path.exists(local_path):
+            # an incomplete download from before .part files were used
+            if os.path.exists(partial_path):
+                os.remove(local_path)
+            else:
+                os.rename(local_path, partial_path)
+        offset = 0
+        if os.path.exists(partial_path):
+            offset = os.stat(partial_path).st_size
+            if offset > job['size']:
+                os.remove(partial_path)
+                offset = 0
+
+        while True:
+            headers = {}
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+            stats.count('download_requests')
+            download_started = time.time()
+            response = httpRequest(job['url'], headers=headers)
+            resumed = (response.status == 206 and
+                       (response.getheader('Content-Range') or '').startswith('bytes %d-' % offset))
+            if not offset or not ((response.status == 416 and offset != job['size']) or
+                                  (response.status == 206 and not resumed)):
+                break
+            # the '.part' file doesn't match what the server has, so it can't
+            # be resumed; start again without a range, which can only happen once
+            response.read()
+            L.log(VERBOSE, "Couldn't resume the download of %s %s from byte %s (HTTP status %s), "
+                  "downloading it from the start." % (job['product'], job['version'], offset,
+                                                      response.status))
+            stats.count('downloads_restarted')
+            os.remove(partial_path)
+            offset = 0
+
+        if offset and response.status == 416:
+            # the '.part' file was already complete
+            response.read()
+            mode = 'ab'
+        elif offset and resumed:
+            L.log(VERBOSE, "Resuming download of %s %s from byte %s." % (
+                job['product'], job['version'], offset))
+            stats.count('downloads_resumed')
+            mode = 'ab'
+        elif response.status == 200:
+            if offset:
+                L.log(VERBOSE, "Server ignored the range request for %s %s, "
+                      "downloading it from the start." % (job['product'], job['version']))
+            mode = 'wb'
+            offset = 0
+        else:
+            response.read()
+            return "HTTP status %s for %s" % (response.status, job['url'])
+
+        hasher = hashlib.sha256()
+        if offset:
+            hashFile(partial_path, hasher)
+        progress.add(offset)
+        with open(partial_path, mode) as output:
+            while True:
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.write(chunk)
+                hasher.update(chunk)
+                progress.add(len(chunk))
+                stats.count('download_bytes', len(chunk))
+        stats.observe('download', time.time() - download_started)
+    except (httplib.HTTPException, socket.error, IOError, OSError) as e:
+        return "%s: %s" % (job['url'], e)
+    finally:
+        progress.fileDone()
+
+    have_bytes = os.stat(partial_path).st_size
+    if have_bytes != job['size']:
+        if have_bytes > job['size']:
+            os.remove(partial_path)
+        return "Downloaded %s bytes from %s, expected %s" % (have_bytes, job['url'], job['size'])
+    os.rename(partial_path, local_path)
+    job['sha256'] = hasher.hexdigest()
+    writeHashSidecar(local_path, job['sha256'])
+    return None
+
+
+def downloadUpdates(jobs, concurrency=1, show_progress=True, manifest=None, blob_store=None):
+    """Downloads a list of job dicts, each with 'product', 'version',
+    'platform', 'url', 'local_path' and 'size' keys, using up to
+    'concurrency' parallel downloads. A failed download doesn't affect the
+    others. Successful downloads are recorded in manifest if one is given.
+    Returns the list of jobs that failed.
+
+    If blob_store is given, downloaded payloads are moved into it, and the
+    jobs in a job's optional 'aliases' list, for the same payload under
+    other names, are linked to it instead of being downloaded again."""
+    if not jobs:
+        return []
+    progress = DownloadProgress(len(jobs), sum(job['size'] for job in jobs),
+                                enabled=show_progress)
+    for job in jobs:
+        L.log(INFO, "Downloading %s %s (%s bytes) to %s" % (
+            job['product'], job['version'], job['size'], job['local_path']))
+    download = lambda job: downloadFile(job, progress)
+    pool = ThreadPool(max(1, min(concurrency, len(jobs))))
+    try:
+        errors = pool.map(download, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = []
+    now = datetime.datetime.utcnow()
+    for job, error in zip(jobs, errors):
+        if not error and blob_store:
+            try:
+                blob_store.add(job['local_path'], job['sha256'],
+                               os.path.basename(urlparse(job['url']).path), job['size'])
+                for alias in job.get('aliases', []):
+                    blob_store.link(job['sha256'], alias['local_path'])
+                    writeHashSidecar(alias['local_path'], job['sha256'])
+            except (IOError, OSError) as e:
+                error = "Couldn't store %s in the blob store: %s" % (job['local_path'], e)
+        if error:
+            L.log(ERROR, "Error downloading %s %s: %s" % (job['product'], job['version'], error))
+            stats.count('download_failures')
+            failed.append(job)
+            failed.extend(job.get('aliases', []))
+        elif manifest:
+            for cached_job in [job] + job.get('aliases', []):
+                recordCachedUpdate(manifest, cached_job, sha256=job['sha256'],
+                                   downloaded=now, last_used=now)
+    return failed
+
+
+def recordCachedUpdate(manifest, job, **fields):
+    """Adds the details of a download job dict to its manifest entry."""
+    manifest.record(os.path.basename(job['local_path']),
+                    product=job['product'],
+                    version=job['version'],
+                    platform=job['platform'],
+                    url=job['url'],
+                    size=job['size'],
+                    **fields)
+
+
+PAYLOAD_EXTENSIONS = {'.dmg': 'mac', '.zip': 'win'}
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parseSize(size):
+    """Returns the number of bytes in a size such as 500000, '750M' or
+    '2T'. Raises ValueError for anything else."""
+    size = str(size).strip().upper()
+    if size and size[-1] == 'B':
+        size = size[:-1]
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def formatSize(num_bytes):
+    for suffix in ('T', 'G', 'M', 'K'):
+        if num_bytes >= SIZE_SUFFIXES[suffix]:
+            return '%.1f%sB' % (float(num_bytes) / SIZE_SUFFIXES[suffix], suffix)
+    return '%d bytes' % num_bytes
+
+
+def getCachedPayloads(manifest):
+    """Returns a dict of the file name of each payload in the cache to a dict
+    with its 'platform', 'product', 'version', 'size', 'last_used' date and
+    'file_id', which is shared by the names linked to the same blob in the
+    'content' cache_layout. Payloads without a manifest entry, such as those cached by older
+    versions of aamporter, are identified by their file names."""
+    payloads = {}
+    for filename in os.listdir(manifest.cache_path):
+        base, ext = os.path.splitext(filename)
+        path = manifest.localPath(filename)
+        if ext not in PAYLOAD_EXTENSIONS or '-' not in base or not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        entry = manifest.get(filename) or {}
+        product, version = base.rsplit('-', 1)
+        payloads[filename] = {
+            'platform': entry.get('platform', PAYLOAD_EXTENSIONS[ext]),
+            'product': entry.get('product', product),
+            'version': entry.get('version', version),
+            'size': st.st_size,
+            'file_id': (st.st_dev, st.st_ino),
+            'last_used': (entry.get('last_used') or entry.get('downloaded') or
+                          datetime.datetime.utcfromtimestamp(st.st_mtime))}
+    return payloads
+
+
+def collectGarbage(manifest, feed_indexes, wanted, max_size=0, max_age=0,
+                   pkginfo_index=None, blob_store=None, delete=False):
+    """Evicts payloads from the cache, returning the list of (file name,
+    reason) tuples evicted, or that would be if delete is False.
+
+    feed_indexes maps each platform to its FeedIndex, and wanted maps each
+    platform to the set of (product, version) tuples the current product
+    plists want, which are never evicted. Neither are payloads for platforms
+    not in feed_indexes, nor, if pkginfo_index is given, payloads that have
+    been imported into the Munki repo.
+
+    Revoked payloads, and those superseded by a higher version in the feed
+    or no longer in it, are evicted unless a max_size budget is given. If
+    max_age (in days) is given, any other payload not used by a run for
+    longer is evicted too.
+    If max_size (in bytes) is given, payloads are evicted until the cache
+    fits: revoked ones first, then superseded ones, then the remaining ones
+    by least recent use. Names linked to the same blob only take up its size
+    once, which is freed when the last of them is evicted, along with the
+    blob if blob_store is given. Blobs already left without any links, for
+    instance by an earlier run with the 'flat' cache_layout, count towards
+    the cache's size and are always removed."""
+    payloads = getCachedPayloads(manifest)
+    # every (product, version) in each platform's feed, and whether it is
+    # revoked in each of its channels
+    in_feed = {}
+    for platform, feed_index in feed_indexes.items():
+        for channel, updates in feed_index.channels.items():
+            for update in updates:
+                revoked = feed_index.revokeCount(channel, update.product, update.version) > -1
+                key = (platform, update.product, update.version)
+                in_feed[key] = in_feed.get(key, True) and revoked
+
+    candidates = []
+    for filename, payload in payloads.items():
+        platform, product, version = payload['platform'], payload['product'], payload['version']
+        if platform not in feed_indexes:
+            L.log(DEBUG, "Keeping %s, its platform wasn't checked in this run." % filename)
+            continue
+        if (product, version) in wanted[platform]:
+            continue
+        if pkginfo_index:
+            sha256 = (manifest.get(filename) or {}).get('sha256')
+            if pkginfo_index.findByHash(sha256 or getFileHash(manifest.localPath(filename))):
+                L.log(DEBUG, "Keeping %s, it has been imported into Munki." % filename)
+                continue
+        if in_feed.get((platform, product, version)):
+            priority, reason = 0, 'revoked'
+        elif (platform, product, version) not in in_feed:
+            priority, reason = 1, 'no longer in the feed'
+        elif feed_indexes[platform].highest_versions.get(product) != version:
+            priority, reason = 1, 'superseded by %s' % feed_indexes[platform].highest_versions.get(product)
+        else:
+            priority, reason = 2, 'not wanted by the product plists'
+        candidates.append((priority, payload['last_used'], filename, reason))
+    candidates.sort()
+
+    # the number of names of each file left in the cache, and their total size
+    links = {}
+    total = 0
+    for payload in payloads.values():
+        links[payload['file_id']] = links.get(payload['file_id'], 0) + 1
+        if links[payload['file_id']] == 1:
+            total += payload['size']
+
+    evict = []
+    evicted = set()
+
+    def markEvicted(candidate):
+        """Adds candidate to evict, returning the bytes this frees."""
+        evict.append(candidate)
+        evicted.add(candidate[2])
+        payload = payloads[candidate[2]]
+        links[payload['file_id']] -= 1
+        return 0 if links[payload['file_id']] else payload['size']
+
+    freed = 0
+    unlinked_blobs = blob_store.unlinkedBlobs() if blob_store else []
+    for blob_path, size in unlinked_blobs:
+        total += size
+        freed += size
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=max_age)
+    for candidate in candidates:
+        if (not max_size and candidate[0] < 2) or (max_age and candidate[1] < cutoff):
+            freed += markEvicted(candidate)
+    if max_size:
+        for candidate in candidates:
+            if total - freed <= max_size:
+                break
+            if candidate[2] not in evicted:
+                freed += markEvicted(candidate)
+        total -= freed
+
+    for blob_path, size in unlinked_blobs:
+        L.log(INFO, "  - %s (%s, no cached payload links to it)" % (
+            os.path.relpath(blob_path, manifest.cache_path), formatSize(size)))
+    for priority, last_used, filename, reason in evict:
+        L.log(INFO, "  - %s (%s, %s, last used %s)" % (
+            filename, formatSize(payloads[filename]['size']), reason, last_used.strftime('%Y-%m-%d')))
+        if delete:
+            path = manifest.localPath(filename)
+            for stale_path in (path, path + HASH_SIDECAR_SUFFIX):
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+            manifest.remove(filename)
+    if max_size and total > max_size:
+        L.log(WARNING, "Warning: The cache will still use %s, over its budget of %s, "
+              "as the rest of it is still needed." % (formatSize(total), formatSize(max_size)))
+    if delete:
+        manifest.save()
+        if blob_store:
+            blob_store.prune()
+        stats.count('gc_evicted', len(evict))
+        stats.count('gc_freed_bytes', freed)
+        L.log(INFO, "Freed %s by removing %s cached payloads." % (formatSize(freed), len(evict)))
+    else:
+        L.log(INFO, "Would free %s by removing %s cached payloads. Use --gc-delete to remove them." % (
+            formatSize(freed), len(evict)))
+    return [(c[2], c[3]) for c in evict]
+
+
+class PkginfoIndex(object):
+    """Index of the pkginfos in a Munki repo by installer_item_hash, built
+    once per run, for answering duplicate checks without scanning the repo
+    for each update.
+
+    The index is built from the repo's catalogs/all, or by reading every
+    pkginfo under pkgsinfo if there is no usable catalog. An index built from
+    catalogs/all is saved in cache_path and reused for as long as the
+    catalog's modification time and size are unchanged."""
+    def __init__(self, repo_path, cache_path=None):
+        self.repo_path = repo_path
+        self.by_hash = {}
+        self.count = 0
+        all_catalog = os.path.join(repo_path, 'catalogs', 'all')
+        index_path = None
+        if cache_path:
+            index_path = os.path.join(cache_path, 'pkginfo_index.pickle')
+
+        if os.path.exists(all_catalog):
+            st = os.stat(all_catalog)
+            key = (all_catalog, st.st_mtime, st.st_size)
+            if index_path and self._load(index_path, key):
+                L.log(VERBOSE, "Loaded saved index of %s pkginfos in the repo." % self.count)
+                return
+            try:
+                pkginfos = plistlib.readPlist(all_catalog)
+            except ExpatError:
+                L.log(WARNING, "Warning: Couldn't parse %s, reading pkginfos instead." % all_catalog)
+            else:
+                for pkginfo in pkginfos:
+                    self.add(pkginfo)
+                L.log(VERBOSE, "Indexed %s pkginfos from %s." % (len(pkginfos), all_catalog))
+                if index_path:
+                    self._save(index_path, key)
+                return
+
+        for root, dirs, files in os.walk(os.path.join(repo_path, 'pkgsinfo')):
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                try:
+                    self.add(plistlib.readPlist(os.path.join(root, name)))
+                except (ExpatError, IOError):
+                    L.log(DEBUG, "Skipping unreadable pkginfo %s" % os.path.join(root, name))
+        L.log(VERBOSE, "Indexed %s pkginfos from the repo's pkgsinfo." % self.count)
+
+    def _load(self, index_path, key):
+        if not os.path.exists(index_path):
+            return False
+        try:
+            with open(index_path, 'rb') as f:
+                saved = cPickle.load(f)
+        except Exception:
+            return False
+        if saved.get('key') != key or 'count' not in saved:
+            return False
+        self.by_hash = saved['by_hash']
+        self.count = saved['count']
+        return True
 
-The second form will generate a product plist containing all channel IDs contained in the
-installer metadata. Accepts either a path to a .cpp file (from Creative Cloud Packager) or
-a mounted ESD volume path for CS6-and-earlier installers.
+    def _save(self, index_path, key):
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump({'key': key,
+                          'by_hash': self.by_hash,
+                          'count': self.count},
+                         f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, index_path)
+
+    def add(self, pkginfo):
+        """Add the identifying keys of a pkginfo dict to the index."""
+        entry = {'name': pkginfo.get('name'),
+                 'version': pkginfo.get('version'),
+                 'installer_item_hash': pkginfo.get('installer_item_hash')}
+        if entry['installer_item_hash']:
+            self.by_hash.setdefault(entry['installer_item_hash'], entry)
+        self.count += 1
+
+    def findByHash(self, installer_item_hash):
+        """Returns the name, version and hash of a pkginfo with the given
+        installer_item_hash, or None."""
+        return self.by_hash.get(installer_item_hash)
+
+
+def runImportJob(job):
+    """Runs the munkiimport or makepkginfo command for a single import job
+    dict, and adds its 'returncode', 'stdout' and 'stderr' to the job."""
+    L.log(INFO, "Importing {0} {1} into Munki. Update for: {2}".format(
+        job['item_name'], job['version'], ', '.join(job['update_catalogs'])))
+    L.log(VERBOSE, "Calling %s on %s version %s, file %s." % (
+        pref('munki_tool'),
+        job['update_name'],
+        job['version'],
+        job['local_path']))
+    import_started = time.time()
+    munkiprocess = subprocess.Popen(job['cmd'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # wait for the process to terminate
+    job['stdout'], job['stderr'] = munkiprocess.communicate()
+    job['returncode'] = munkiprocess.returncode
+    stats.observe('import', time.time() - import_started)
+    stats.count('imports')
+    if job['returncode']:
+        stats.count('import_failures')
+        L.log(ERROR, "%s returned an error for %s %s. Skipping update.." % (
+            pref('munki_tool'), job['item_name'], job['version']))
+        if job['stderr']:
+            L.log(VERBOSE, job['stderr'].strip())
+    else:
+        if pref('munki_tool') == 'makepkginfo':
+            plist_path = os.path.splitext(job['local_path'])[0] + ".plist"
+            with open(plist_path, "w") as plist:
+                plist.write(job['stdout'])
+                L.log(INFO, "pkginfo written to %s" % plist_path)
+        elif pref('munki_tool') == 'munkiimport':
+            saved = re.search(r"^Saved pkginfo to (.+?)\.?$", job['stdout'], re.MULTILINE)
+            if saved:
+                job['pkginfo_path'] = saved.group(1)
+    return job
+
+
+def writeCatalog(path, items):
+    """Writes a catalog plist via a temporary file and a rename, so that
+    clients never see a partially-written catalog."""
+    tmp_path = os.path.join(os.path.dirname(path), '.%s.tmp' % os.path.basename(path))
+    plistlib.writePlist(items, tmp_path)
+    os.rename(tmp_path, path)
+
+
+def updateCatalogs(repo_path, pkginfo_paths):
+    """Merges the pkginfos at pkginfo_paths into the repo's existing catalogs,
+    rather than rebuilding every catalog from all of pkgsinfo as makecatalogs
+    does. Each affected catalog is read and written once.
+
+    As with makecatalogs, each pkginfo is added to catalogs/all and to each
+    catalog in its 'catalogs' array, without its 'notes' and '_'-prefixed
+    keys. A catalog entry with the same name, version, installer item
+    location and hash as a merged pkginfo is replaced."""
+    identity = lambda item: (item.get('name'), item.get('version'),
+                             item.get('installer_item_location'),
+                             item.get('installer_item_hash'))
+    pkginfos = []
+    for pkginfo_path in pkginfo_paths:
+        pkginfo = plistlib.readPlist(pkginfo_path)
+        for key in pkginfo.keys():
+            if key == 'notes' or key.startswith('_'):
+                del pkginfo[key]
+        pkginfos.append(pkginfo)
+
+    catalog_names = set(['all'])
+    for pkginfo in pkginfos:
+        catalog_names.update(pkginfo.get('catalogs', []))
+    catalogs_dir = os.path.join(repo_path, 'catalogs')
+    if not os.path.isdir(catalogs_dir):
+        os.makedirs(catalogs_dir)
+
+    for catalog_name in sorted(catalog_names):
+        catalog_path = os.path.join(catalogs_dir, catalog_name)
+        items = []
+        if os.path.exists(catalog_path):
+            items = plistlib.readPlist(catalog_path)
+        for pkginfo in pkginfos:
+            if catalog_name != 'all' and catalog_name not in pkginfo.get('catalogs', []):
+                continue
+            items = [item for item in items if identity(item) != identity(pkginfo)]
+            items.append(pkginfo)
+        writeCatalog(catalog_path, items)
+        L.log(VERBOSE, "Updated catalog %s." % catalog_name)
+
+
+def runImportJobs(jobs, concurrency=1):
+    """Runs a list of import job dicts (see runImportJob) on a pool of up to
+    'concurrency' workers. Jobs sharing a 'destination' are run one after
+    another, in order, by the same worker, while jobs for different
+    destinations run in parallel. Returns the finished jobs."""
+    groups = OrderedDict()
+    for job in jobs:
+        groups.setdefault(job['destination'], []).append(job)
+    run_group = lambda group: [runImportJob(job) for job in group]
+    pool = ThreadPool(max(1, min(concurrency, len(groups))))
+    try:
+        results = pool.map(run_group, groups.values())
+    finally:
+        pool.close()
+        pool.join()
+    return [job for group in results for job in group]
+
+
+def parseByteRange(header, size):
+    """Returns the (first, last) byte offsets of a file of 'size' bytes
+    requested by a Range header, or None if the header should be ignored and
+    the whole file sent: if it is missing, malformed or asks for multiple
+    ranges. Raises ValueError if the range can't be satisfied."""
+    match = re.match(r'^bytes=(\d*)-(\d*)$', (header or '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # a suffix range, the last 'last' bytes
+        if int(last) == 0:
+            raise ValueError(header)
+        return (max(0, size - int(last)), size - 1)
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size or last < first:
+        raise ValueError(header)
+    return (first, last)
+
+
+class CacheMirror(object):
+    """Maps requests for Adobe's update server URLs to the contents of
+    local_cache_path, for --serve mode:
+
+    - webfeed/oobe/aam20/<platform>/updaterfeed.xml: the cached feed
+    - updates/oobe/aam20/<platform>/<product>/<version>/<version>.xml: a
+      details XML made from the details cache (see formatUpdateDetails)
+    - updates/oobe/aam20/<platform>/<product>/<version>/<file>: a payload
+      recorded in the cache manifest as downloaded from that URL
+
+    The manifest is read again whenever it changes, so payloads cached by a
+    run after the mirror was started are served too."""
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.payloads = {}
+        self.manifest_mtime = None
+        self.details_cache = DetailsCache(os.path.join(cache_path, 'details.db'),
+                                          negative_ttl=pref('details_negative_ttl'),
+                                          shared=True)
+
+    def _payloadPaths(self):
+        """Returns a dict of update URL paths to payload files in the cache."""
+        manifest_path = os.path.join(self.cache_path, 'manifest.plist')
+        try:
+            mtime = os.stat(manifest_path).st_mtime
+        except OSError:
+            return {}
+        with self.lock:
+            if mtime != self.manifest_mtime:
+                manifest = CacheManifest(self.cache_path)
+                payloads = {}
+                for filename, entry in manifest.entries.items():
+                    url_path = urlparse(entry.get('url', '')).path
+                    if UPDATE_PATH_PREFIX in url_path:
+                        payloads[url_path[url_path.index(UPDATE_PATH_PREFIX):]] = \
+                            manifest.localPath(filename)
+                self.payloads = payloads
+                self.manifest_mtime = mtime
+            return self.payloads
+
+    def resolve(self, request_path):
+        """Returns a tuple of ('file', path) or ('data', string) with what to
+        serve for a request path, or None if there is nothing to serve."""
+        path = urlparse(request_path).path
+        for prefix in ('webfeed/oobe/aam20/', UPDATE_PATH_PREFIX):
+            if prefix in path:
+                path = path[path.index(prefix):]
+                break
+        else:
+            return None
+        parts = path.split('/')
+        if '..' in parts:
+            return None
+        if path.startswith('webfeed/'):
+            if len(parts) == 5 and parts[4] == 'updaterfeed.xml':
+                feed_path = os.path.join(self.cache_path, 'feeds', parts[3], 'updaterfeed.xml')
+                if os.path.isfile(feed_path):
+                    return ('file', feed_path)
+            return None
+        if len(parts) != 7:
+            return None
+        platform, product, version, filename = parts[3:]
+        if filename == '%s.xml' % version:
+            with self.lock:
+                cached = self.details_cache.get(platform, product, version)
+            if cached and cached[1]:
+                return ('data', formatUpdateDetails(cached[1]))
+            return None
+        payload_path = self._payloadPaths().get(path)
+        if payload_path and os.path.isfile(payload_path):
+            return ('file', payload_path)
+        return None
 
-See %prog --help for more options and the README for more detail."""
 
-    o = optparse.OptionParser(usage=usage)
-    o.add_option("-l", "--platform", type='choice', choices=['mac', 'win'], default='mac',
-        help="Download Adobe updates for Mac or Windows. Available options are 'mac' or 'win', defaults to 'mac'.")
-    o.add_option("-m", "--munkiimport", action="store_true", default=False,
-        help="Process downloaded updates with munkiimport using options defined in %s." % os.path.basename(settings_plist))
-    o.add_option("-r", "--include-revoked", action="store_true", default=False,
-        help="Include updates that have been marked as revoked in Adobe's feed XML.")
-    o.add_option("--skip-cc", action="store_true", default=False,
-        help=("Skip updates for Creative Cloud updates. Useful for certain updates for "
-              "CS-era applications that incorporate CC subscription updates."))
-    o.add_option("-f", "--force-import", action="store_true", default=False,
-        help="Run munkiimport even if it finds an identical pkginfo and installer_item_hash in the repo.")
-    o.add_option("-c", "--make-catalogs", action="store_true", default=False,
-        help="Automatically run makecatalogs after importing into Munki.")
-    o.add_option("-p", "--product-plist", "--plist", action="append", default=[],
-        help="Deprecated option for specifying product plists, kept for compatibility. Instead, pass plist paths \
-as arguments.")
-    o.add_option("-b", "--build-product-plist", action="store",
-        help="Given a path to either a mounted Adobe product ESD installer or a .ccp file from a package built with CCP, \
-save a product plist containing every Channel ID found for the product. Plist is saved to the current working directory.")
-    o.add_option("-u", "--munki-update-for", action="store",
-        help="To be used with the --build-product-plist option, specifies the base Munki product.")
-    o.add_option("-v", "--verbose", action="count", default=0,
-        help="Output verbosity. Can be specified either '-v' or '-vv'.")
-    o.add_option("--no-colors", action="store_true", default=False,
-        help="Disable colored ANSI output.")
-    o.add_option("--no-progressbar", action="store_true", default=False,
-        help="Disable the progress indicator.")
+class CacheMirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the files of the server's CacheMirror, with keep-alive
+    connections, conditional GETs and single byte ranges. Files are sent with
+    os.sendfile where it is available."""
+    protocol_version = 'HTTP/1.1'
+    server_version = 'aamporter'
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def sendEmpty(self, status, headers=()):
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def respond(self, send_body):
+        resource = self.server.mirror.resolve(self.path)
+        if resource is None:
+            self.sendEmpty(404)
+            return
+        kind, value = resource
+        if kind == 'data':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml')
+            self.send_header('Content-Length', str(len(value)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(value)
+            return
+
+        with open(value, 'rb') as f:
+            st = os.fstat(f.fileno())
+            etag = '"%x-%x"' % (st.st_size, int(st.st_mtime))
+            last_modified = self.date_time_string(st.st_mtime)
+            if (self.headers.get('If-None-Match') == etag or
+                    (not self.headers.get('If-None-Match') and
+                     self.headers.get('If-Modified-Since') == last_modified)):
+                self.sendEmpty(304, [('ETag', etag)])
+                return
+            try:
+                byte_range = parseByteRange(self.headers.get('Range'), st.st_size)
+            except ValueError:
+                self.sendEmpty(416, [('Content-Range', 'bytes */%d' % st.st_size)])
+                return
+            if byte_range:
+                first, last = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last, st.st_size))
+            else:
+                first, last = 0, st.st_size - 1
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(last - first + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            if send_body:
+                self.sendFileRange(f, first, last - first + 1)
+
+    def sendFileRange(self, f, offset, length):
+        sendfile = getattr(os, 'sendfile', None)
+        if sendfile:
+            self.wfile.flush()
+            while length > 0:
+                sent = sendfile(self.connection.fileno(), f.fileno(), offset, length)
+                if not sent:
+                    break
+                offset += sent
+                length -= sent
+        else:
+            f.seek(offset)
+            while length > 0:
+                chunk = f.read(min(length, DOWNLOAD_CHUNK_SIZE))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                length -= len(chunk)
+
+    def handle_one_request(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        except socket.error as e:
+            # the client went away
+            L.log(DEBUG, "Connection from %s closed: %s" % (self.address_string(), e))
+            self.close_connection = 1
 
-    opts, args = o.parse_args()
+    def log_message(self, format, *args):
+        L.log(VERBOSE, "%s - %s" % (self.address_string(), format % args))
 
-    # setup logging
-    global L
-    L = logging.getLogger('com.github.aamporter')
-    log_stdout_handler = logging.StreamHandler(stream=sys.stdout)
-    log_stdout_handler.setFormatter(ColorFormatter(
-        use_color=not opts.no_colors))
-    L.addHandler(log_stdout_handler)
-    # INFO is level 30, so each verbose option count lowers level by 10
-    L.setLevel(INFO - (10 * opts.verbose))
 
-    # arg/opt processing
-    if len(sys.argv) == 1:
-        o.print_usage()
-        sys.exit(0)
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
 
-    # any args we just pass through to the "legacy" --product-plist/--plist options
-    if args:
-        opts.product_plist.extend(args)
-    if opts.munki_update_for and not opts.build_product_plist:
-        errorExit("--munki-update-for requires the --build-product-plist option!")
-    if not opts.build_product_plist and not opts.product_plist:
-        errorExit("One of --product-plist or --build-product-plist must be specified!")
-    if opts.platform == 'win' and opts.munkiimport:
-        errorExit("Cannot use the --munkiimport option with --platform win option!")
 
-    if opts.build_product_plist:
-        esd_path = opts.build_product_plist
-        if esd_path.endswith('/'):
-            esd_path = esd_path[0:-1]
-        plist = buildProductPlist(esd_path, opts.munki_update_for)
-        if not plist:
-            errorExit("Couldn't build payloads from path %s." % esd_path)
-        else:
-            if opts.munki_update_for:
-                output_plist_name = opts.munki_update_for
-            else:
-                output_plist_name = os.path.basename(esd_path.replace(' ', ''))
-            output_plist_name += '.plist'
-            output_plist_file = os.path.join(os.getcwd(), output_plist_name)
-            if os.path.exists(output_plist_file):
-                errorExit("A file already exists at %s, not going to overwrite." %
-                    output_plist_file)
-            try:
-                plistlib.writePlist(plist, output_plist_file)
-            except:
-                errorExit("Error writing plist to %s" % output_plist_file)
-            print "Product plist written to %s" % output_plist_file
-            sys.exit(0)
-
-    # munki sanity checks
-    if opts.munkiimport:
-        if not os.path.exists('/usr/local/munki'):
-            errorExit("No Munki installation could be found. Get it at http://code.google.com/p/munki")
-        sys.path.insert(0, MUNKI_DIR)
-        munkiimport_prefs = os.path.expanduser('~/Library/Preferences/com.googlecode.munki.munkiimport.plist')
-        if pref('munki_tool') == 'munkiimport':
-            if not os.path.exists(munkiimport_prefs):
-                errorExit("Your Munki repo seems to not be configured. Run munkiimport --configure first.")
-            try:
-                import imp
-                # munkiimport doesn't end in .py, so we use imp to make it available to the import system
-                imp.load_source('munkiimport', os.path.join(MUNKI_DIR, 'munkiimport'))
-                import munkiimport
-                munkiimport.REPO_PATH = munkiimport.pref('repo_path')
-            except ImportError:
-                errorExit("There was an error importing munkilib, which is needed for --munkiimport functionality.")
-
-            # rewrite some of munkiimport's function names since they were changed to
-            # snake case around 2.6.1:
-            # https://github.com/munki/munki/commit/e3948104e869a6a5eb6b440559f4c57144922e71
-            try:
-                munkiimport.repoAvailable()
-            except AttributeError:
-                munkiimport.repoAvailable = munkiimport.repo_available
-                munkiimport.makePkgInfo = munkiimport.make_pkginfo
-                munkiimport.findMatchingPkginfo = munkiimport.find_matching_pkginfo
-                munkiimport.makeCatalogs = munkiimport.make_catalogs
-            if not munkiimport.repoAvailable():
-                errorExit("The Munki repo cannot be located. This tool is not interactive; first ensure the repo is mounted.")
-
-    # set up the cache path
+def startMirror(cache_path, address):
+    """Starts serving cache_path to other aamporter instances on address,
+    '[host:]port', in a background thread. Returns the server."""
+    host, _, port = address.rpartition(':')
+    try:
+        server = ThreadingHTTPServer((host or '0.0.0.0', int(port)), CacheMirrorHandler)
+    except (ValueError, socket.error) as e:
+        errorExit("Couldn't serve on %s: %s" % (address, e))
+    server.mirror = CacheMirror(cache_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    L.log(INFO, "Serving %s on http://%s:%s/" % ((cache_path,) + server.server_address))
+    return server
+
+
+def setupCachePath():
+    """Creates local_cache_path if needed and returns it."""
     local_cache_path = pref('local_cache_path')
     if os.path.exists(local_cache_path) and not os.path.isdir(local_cache_path):
         errorExit("Local cache path %s was specified and exists, but it is not a directory!" %
@@ -578,32 +2320,220 @@ save a product plist containing every Channel ID found for the product. Plist is
         os.access(local_cache_path, os.W_OK)
     except:
         errorExit("Cannot write to local cache path!" % local_cache_path)
+    return local_cache_path
 
-    # load our product plists
+
+def downloadConcurrency(opts):
+    if opts.jobs is not None:
+        return opts.jobs
+    return pref('download_concurrency')
+
+
+def loadProductPlists(paths, loaded=None):
+    """Reads the product plists at paths. Returns a tuple of the list of
+    plists, a dict of each plist's absolute path to its channels, and a dict
+    of each plist's absolute path to a digest of its contents.
+
+    If a 'loaded' dict is given, plists are cached in it and only read again
+    when their modification time or size changes."""
+    if loaded is None:
+        loaded = {}
     product_plists = []
-    for plist_path in opts.product_plist:
+    plist_channels = {}
+    plist_digests = {}
+    for plist_path in paths:
+        plist_path = os.path.abspath(plist_path)
         try:
-            plist = plistlib.readPlist(plist_path)
+            st = os.stat(plist_path)
+            stamp = (st.st_mtime, st.st_size)
+            if plist_path not in loaded or loaded[plist_path][0] != stamp:
+                with open(plist_path, 'rb') as f:
+                    plist_data = f.read()
+                loaded[plist_path] = (stamp, plistlib.readPlistFromString(plist_data),
+                                      hashlib.sha1(plist_data).hexdigest())
+            plist, digest = loaded[plist_path][1:]
         except:
             errorExit("Couldn't read plist at %s!" % plist_path)
         if 'channels' not in plist.keys():
             errorExit("Plist at %s is missing a 'channels' array, which is required." % plist_path)
         else:
             product_plists.append(plist)
+            plist_channels[plist_path] = plist['channels']
+            plist_digests[plist_path] = digest
+    return product_plists, plist_channels, plist_digests
+
+
+def writeStatus(status_path, status):
+    tmp_path = status_path + '.tmp'
+    plistlib.writePlist(status, tmp_path)
+    os.rename(tmp_path, status_path)
+
+
+def watch(opts, local_cache_path):
+    """Runs aamporter repeatedly, every opts.watch_interval seconds give or
+    take up to opts.watch_jitter seconds, keeping the munkiimport module and
+    product plists loaded between runs. Each run only processes channels
+    that changed since the previous one (see --incremental), and settings and
+    product plists are reloaded when their modification times change.
+
+    The state and outcome of the last run are written to status.plist in the
+    cache path, for health checks."""
+    opts.incremental = True
+    status_path = os.path.join(local_cache_path, 'status.plist')
+    loaded_plists = {}
+    status = {'pid': os.getpid(),
+              'started': datetime.datetime.utcnow(),
+              'runs': 0,
+              'consecutive_failures': 0}
+    while True:
+        run_started = datetime.datetime.utcnow()
+        status.update({'state': 'running', 'last_run_started': run_started})
+        writeStatus(status_path, status)
+        try:
+            if settings.reloadIfChanged():
+                L.log(INFO, "Reloaded settings from %s." % settings.path)
+            runWithStats(opts, loaded_plists)
+            status['last_run_result'] = 'success'
+            status['consecutive_failures'] = 0
+        except SystemExit:
+            # errorExit() was called, which has already logged the error
+            status['last_run_result'] = 'failed'
+            status['consecutive_failures'] += 1
+        except Exception as e:
+            L.exception("Unexpected error during run: %s" % e)
+            status['last_run_result'] = 'failed'
+            status['consecutive_failures'] += 1
+        # drop anything left over from the run before sleeping
+        gc.collect()
+
+        delay = max(0, opts.watch_interval + random.uniform(-opts.watch_jitter, opts.watch_jitter))
+        now = datetime.datetime.utcnow()
+        status.update({'state': 'idle',
+                       'runs': status['runs'] + 1,
+                       'healthy': status['consecutive_failures'] == 0,
+                       'last_run_finished': now,
+                       'last_run_duration': (now - run_started).total_seconds(),
+                       'next_run': now + datetime.timedelta(seconds=delay)})
+        writeStatus(status_path, status)
+        L.log(INFO, "Run finished (%s), next run in %d seconds." % (status['last_run_result'], delay))
+        time.sleep(delay)
+
+
+def mapPlatforms(func, platforms):
+    """Calls func for each platform in parallel threads, returning a dict of
+    each platform to its result. An exception raised by func for any
+    platform, including the SystemExit of errorExit(), is raised again in the
+    calling thread."""
+    def call(platform):
+        try:
+            return (func(platform), None)
+        except BaseException:
+            return (None, sys.exc_info())
 
-    # sanity-check the settings plist for unknown keys
-    if os.path.exists(settings_plist):
+    if len(platforms) > 1:
+        pool = ThreadPool(len(platforms))
         try:
-            app_options = plistlib.readPlist(settings_plist)
-        except:
-            errorExit("There was an error loading the settings plist at %s" % settings_plist)
-        for k in app_options.keys():
-            if k not in supported_settings_keys:
-                print "Warning: Unknown setting in %s: %s" % (os.path.basename(settings_plist), k)
+            results = pool.map(call, platforms)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(call, platforms)
+    for result, exc_info in results:
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+    return dict((platform, result) for platform, (result, _) in zip(platforms, results))
+
+
+def fetchChannelDetails(feed_index, channels, platform, local_cache_path):
+    """Fetches the details of every update in the given channels of a
+    platform's feed, via the details cache. Returns a dict of (product,
+    version) tuples to UpdateDetails, as fetchUpdateDetails does."""
+    update_keys = []
+    for channelid in channels:
+        for update in getUpdatesForChannel(channelid, feed_index) or []:
+            update_keys.append((update.product, update.version))
+    # SQLite connections can't be shared between threads, so each call opens
+    # its own
+    details_cache = DetailsCache(os.path.join(local_cache_path, 'details.db'),
+                                 negative_ttl=pref('details_negative_ttl'))
+    try:
+        return fetchUpdateDetails(update_keys, platform, details_cache,
+                                  workers=pref('details_fetch_concurrency'))
+    finally:
+        details_cache.close()
+
+
+def runGarbageCollection(opts, manifest, feed_indexes, wanted):
+    """Calls collectGarbage with the budgets from opts or the cache_max_size
+    and cache_max_age settings, protecting every update wanted by a channel
+    of the current product plists. With --include-revoked, every version of
+    an update in those channels is protected, revoked ones included."""
+    if opts.gc_max_size is not None:
+        max_size = opts.gc_max_size
+    else:
+        try:
+            max_size = parseSize(pref('cache_max_size'))
+        except ValueError:
+            errorExit("Couldn't understand the cache_max_size setting: %s" % pref('cache_max_size'))
+    if opts.gc_max_age is not None:
+        max_age = opts.gc_max_age
+    else:
+        max_age = pref('cache_max_age')
+    pkginfo_index = None
+    if opts.gc_keep_imported:
+        # loaded by main(), unless munki_tool was changed to makepkginfo
+        # since, in --watch mode
+        if 'munkiimport' not in sys.modules:
+            errorExit("--gc-keep-imported can't be used with munki_tool set to '%s'." % pref('munki_tool'))
+        import munkiimport
+        pkginfo_index = PkginfoIndex(munkiimport.REPO_PATH, manifest.cache_path)
+    platform_wanted = dict(
+        (platform, set().union(*channel_wanted.values()) if channel_wanted else set())
+        for platform, channel_wanted in wanted.items())
+    if opts.include_revoked:
+        for platform, channel_wanted in wanted.items():
+            for channel in channel_wanted:
+                platform_wanted[platform].update(
+                    (update.product, update.version)
+                    for update in feed_indexes[platform].channels.get(channel, []))
+    L.log(INFO, "Collecting garbage in the cache..")
+    # blobs are pruned whatever the cache_layout is now, as they may be left
+    # over from a run with the 'content' layout
+    blob_store = BlobStore(manifest)
+    if not os.path.isdir(blob_store.path):
+        blob_store = None
+    collectGarbage(manifest, feed_indexes, platform_wanted, max_size=max_size, max_age=max_age,
+                   pkginfo_index=pkginfo_index, blob_store=blob_store, delete=opts.gc_delete)
+
+
+def runAamporter(opts, loaded_plists=None):
+    """Checks the feed for updates to the channels in the product plists given
+    in opts, caches them, and optionally imports them into Munki."""
+    local_cache_path = setupCachePath()
+    _version_keys.clear()
+    manifest = CacheManifest(local_cache_path)
+    blob_store = None
+    if pref('cache_layout') == 'content':
+        blob_store = BlobStore(manifest)
+    download_concurrency = downloadConcurrency(opts)
+    if opts.munkiimport and pref('munki_tool') == 'munkiimport':
+        # loaded by main()
+        import munkiimport
+        # checked on every run, as in --watch mode the repo may have been
+        # unmounted since the last one
+        if not munkiimport.repoAvailable():
+            errorExit("The Munki repo cannot be located. This tool is not interactive; first ensure the repo is mounted.")
+
+    # load our product plists
+    product_plists, plist_channels, plist_digests = loadProductPlists(
+        opts.product_plist, loaded_plists)
 
     L.log(INFO, "Starting aamporter run..")
     if opts.munkiimport:
         L.log(INFO, "Will import into Munki (--munkiimport option given).")
+        if len(opts.platform) > 1:
+            L.log(INFO, "Only mac updates will be imported.")
 
     L.log(DEBUG, "aamporter preferences:")
     for key in supported_settings_keys:
@@ -615,88 +2545,216 @@ save a product plist containing every Channel ID found for the product. Plist is
         L.log(VERBOSE, ("Python 2.7.10 detected, using HTTP feed URLs to work "
                         "around SSL issues."))
 
-    # pull feed info and populate channels
-    L.log(INFO, "Retrieving feed data..")
-    feed = getFeedData(opts.platform)
-    parsed = parseFeedData(feed)
+    # the channels wanted are the same for every platform
     channels = getChannelsFromProductPlists(product_plists)
-    L.log(INFO, "Processing the following Channel IDs:")
-    [ L.log(INFO, "  - %s" % channel) for channel in sorted(channels) ]
-
-    # begin caching run and build updates dictionary with product/version info
-    updates = {}
-    for channelid in channels.keys():
-        L.log(VERBOSE, "Getting updates for Channel ID %s.." % channelid)
-        channel_updates = getUpdatesForChannel(channelid, parsed)
-        if not channel_updates:
-            L.log(DEBUG, "No updates for channel %s" % channelid)
-            continue
-        channel_updates = addUpdatesXML(channel_updates, opts.platform, skipTargetLicensingCC=opts.skip_cc)
-
-        for update in channel_updates:
-            L.log(VERBOSE, "Considering update %s, %s.." % (update.product, update.version))
 
-            if opts.include_revoked is False:
-                highest_version = getHighestVersionOfProduct(channel_updates, update.product)
-                if update.version != highest_version:
-                    L.log(DEBUG, "%s is not the highest version available (%s) for this update. Skipping.." % (
-                        update.version, highest_version))
-                    continue
-
-                if updateIsRevoked(update.channel, update.product, update.version, parsed):
-                    L.log(DEBUG, "Update is revoked. Skipping update.")
-                    continue
-
-                file_element = update.xml.find('InstallFiles/File')
-                if file_element is None:
-                    L.log(DEBUG, "No File XML element found. Skipping update.")
-                else:
-                    filename = file_element.find('Name').text
-                    update_bytes = file_element.find('Size').text
-                    description = update.xml.find('Description/en_US').text
-                    display_name = update.xml.find('DisplayName/en_US').text
-
-                    if not update.product in updates.keys():
-                        updates[update.product] = {}
-                    if not update.version in updates[update.product].keys():
-                        updates[update.product][update.version] = {}
-                        updates[update.product][update.version]['channel_ids'] = []
-                        updates[update.product][update.version]['update_for'] = []
-                    updates[update.product][update.version]['channel_ids'].append(update.channel)
-                    for opt in ['munki_repo_destination_path',
-                                'munki_update_for',
-                                'makepkginfo_options']:
-                        if opt in channels[update.channel].keys():
-                            updates[update.product][update.version][opt] = channels[update.channel][opt]
-                    updates[update.product][update.version]['description'] = description
-                    updates[update.product][update.version]['display_name'] = display_name
-                    dmg_url = urljoin(getURL('updates'), UPDATE_PATH_PREFIX + opts.platform) + \
-                            '/%s/%s/%s' % (update.product, update.version, filename)
-                    output_filename = os.path.join(local_cache_path, "%s-%s.%s" % (
-                            update.product, update.version, 'dmg' if opts.platform == 'mac' else 'zip'))
-                    updates[update.product][update.version]['local_path'] = output_filename
-                    need_to_dl = True
-                    if os.path.exists(output_filename):
-                        we_have_bytes = os.stat(output_filename).st_size
-                        if we_have_bytes == int(update_bytes):
-                            L.log(INFO, "Skipping download of %s %s, it is already cached."
-                                % (update.product, update.version))
-                            need_to_dl = False
-                        else:
-                            L.log(VERBOSE, "Incomplete download (%s bytes on disk, should be %s), re-starting." % (
-                                we_have_bytes, update_bytes))
-                    if need_to_dl:
-                        L.log(INFO, "Downloading %s %s (%s bytes) to %s" % (update.product, update.version, update_bytes, output_filename))
-                        if opts.no_progressbar:
-                            urllib.urlretrieve(dmg_url, output_filename)
-                        else:
-                            urllib.urlretrieve(dmg_url, output_filename, reporthook)
+    # pull feed info, for all platforms at once
+    stats.startPhase('feed')
+    L.log(INFO, "Retrieving feed data..")
+    if opts.feed_max_age is not None:
+        feed_max_age = opts.feed_max_age
+    else:
+        feed_max_age = pref('feed_max_age')
+    feed_indexes = mapPlatforms(
+        lambda platform: FeedIndex(parseFeedData(getFeedData(platform, max_age=feed_max_age))),
+        opts.platform)
+
+    # compare each platform's feed with the snapshot from its previous run
+    stats.startPhase('channels')
+    # these options change which updates are processed or what is done with
+    # them, so a snapshot taken with different ones can't be used to skip
+    # channels
+    options_key = 'skip_cc=%s,include_revoked=%s,munkiimport=%s,munki_tool=%s,force_import=%s' % (
+        opts.skip_cc, opts.include_revoked, opts.munkiimport,
+        pref('munki_tool') if opts.munkiimport else None, opts.force_import)
+    snapshots = {}
+    channel_digests = {}
+    wanted = {}
+    process_channels = {}
+    for platform in opts.platform:
+        feed_index = feed_indexes[platform]
+        snapshots[platform] = FeedSnapshot(local_cache_path, platform)
+        channel_digests[platform] = dict((c, channelDigest(feed_index, c)) for c in channels)
+        wanted[platform] = dict((c, resolveWantedUpdates(feed_index, c)) for c in channels)
+        if opts.changes_only:
+            if len(opts.platform) > 1:
+                L.log(INFO, "Changes for platform %s:" % platform)
+            reportChanges(snapshots[platform], wanted[platform], feed_index)
+            continue
+        process_channels[platform] = sorted(channels)
+        if opts.incremental:
+            changed = snapshots[platform].changedChannels(
+                channel_digests[platform], plist_channels, plist_digests, options_key)
+            process_channels[platform] = [c for c in process_channels[platform] if c in changed]
+            L.log(INFO, "%s of %s channels changed since the last run (%s)." % (
+                len(process_channels[platform]), len(channels), platform))
+    if opts.changes_only:
+        return
+    if opts.gc_only:
+        stats.startPhase('gc')
+        runGarbageCollection(opts, manifest, feed_indexes, wanted)
+        return
 
+    L.log(INFO, "Processing the following Channel IDs:")
+    for platform in opts.platform:
+        for channel in process_channels[platform]:
+            if len(opts.platform) > 1:
+                L.log(INFO, "  - %s (%s)" % (channel, platform))
+            else:
+                L.log(INFO, "  - %s" % channel)
+
+    # fetch details for every update across all channels up front, so that
+    # updates in channels shared between products are only fetched once
+    stats.startPhase('details')
+    details = mapPlatforms(
+        lambda platform: fetchChannelDetails(
+            feed_indexes[platform], process_channels[platform], platform, local_cache_path),
+        opts.platform)
+
+    # begin caching run and build updates dictionary with product/version info,
+    # for each platform
+    platform_updates = {}
+    download_jobs = {}
+    # (feed file name, size) of each payload to download, for the 'content'
+    # cache_layout
+    blob_downloads = {}
+    for platform in opts.platform:
+        feed_index = feed_indexes[platform]
+        updates = platform_updates.setdefault(platform, {})
+        for channelid in process_channels[platform]:
+            L.log(VERBOSE, "Getting updates for Channel ID %s.." % channelid)
+            channel_updates = getUpdatesForChannel(channelid, feed_index)
+            if not channel_updates:
+                L.log(DEBUG, "No updates for channel %s" % channelid)
+                continue
+            channel_updates = addUpdatesXML(channel_updates, platform,
+                                            skipTargetLicensingCC=opts.skip_cc,
+                                            details=details[platform])
+            # highest versions are resolved against the channel's updates that
+            # survived addUpdatesXML, once per channel rather than once per update
+            highest_versions = getHighestVersionsOfProducts(channel_updates)
+
+            for update in channel_updates:
+                L.log(VERBOSE, "Considering update %s, %s.." % (update.product, update.version))
+
+                if opts.include_revoked is False:
+                    highest_version = highest_versions.get(update.product)
+                    if update.version != highest_version:
+                        L.log(DEBUG, "%s is not the highest version available (%s) for this update. Skipping.." % (
+                            update.version, highest_version))
+                        continue
+
+                    if updateIsRevoked(update.channel, update.product, update.version, feed_index):
+                        L.log(DEBUG, "Update is revoked. Skipping update.")
+                        continue
+
+                    if update.details.file_name is None:
+                        L.log(DEBUG, "No File XML element found. Skipping update.")
+                    else:
+                        filename = update.details.file_name
+                        update_bytes = update.details.file_size
+                        description = update.details.description
+                        display_name = update.details.display_name
+
+                        if not update.product in updates.keys():
+                            updates[update.product] = {}
+                        if not update.version in updates[update.product].keys():
+                            updates[update.product][update.version] = {}
+                            updates[update.product][update.version]['channel_ids'] = []
+                            updates[update.product][update.version]['update_for'] = []
+                        updates[update.product][update.version]['channel_ids'].append(update.channel)
+                        for opt in ['munki_repo_destination_path',
+                                    'munki_update_for',
+                                    'makepkginfo_options']:
+                            if opt in channels[update.channel].keys():
+                                updates[update.product][update.version][opt] = channels[update.channel][opt]
+                        updates[update.product][update.version]['description'] = description
+                        updates[update.product][update.version]['display_name'] = display_name
+                        dmg_url = urljoin(getURL('updates'), UPDATE_PATH_PREFIX + platform) + \
+                                '/%s/%s/%s' % (update.product, update.version, filename)
+                        output_filename = os.path.join(local_cache_path, "%s-%s.%s" % (
+                                update.product, update.version, 'dmg' if platform == 'mac' else 'zip'))
+                        updates[update.product][update.version]['local_path'] = output_filename
+                        download_job = {
+                            'product': update.product,
+                            'version': update.version,
+                            'platform': platform,
+                            'url': dmg_url,
+                            'local_path': output_filename,
+                            'size': int(update_bytes)}
+                        need_to_dl = output_filename not in download_jobs
+                        if need_to_dl and os.path.exists(output_filename):
+                            we_have_bytes = os.stat(output_filename).st_size
+                            if we_have_bytes == int(update_bytes):
+                                L.log(INFO, "Skipping download of %s %s, it is already cached."
+                                    % (update.product, update.version))
+                                need_to_dl = False
+                                sha256 = None
+                                if blob_store:
+                                    # moves payloads cached in the flat layout into the store
+                                    try:
+                                        sha256 = getFileHash(output_filename)
+                                        blob_store.add(output_filename, sha256, filename, int(update_bytes))
+                                    except (IOError, OSError) as e:
+                                        L.log(ERROR, "Couldn't move %s into the blob store, keeping it "
+                                              "where it is: %s" % (output_filename, e))
+                                recordCachedUpdate(manifest, download_job, sha256=sha256,
+                                                   last_used=datetime.datetime.utcnow())
+                            else:
+                                L.log(VERBOSE, "Incomplete download (%s bytes on disk, should be %s), resuming." % (
+                                    we_have_bytes, update_bytes))
+                        if need_to_dl and blob_store:
+                            sha256 = blob_store.find(filename, int(update_bytes))
+                            blob_key = (filename, int(update_bytes))
+                            if sha256:
+                                L.log(INFO, "Skipping download of %s %s, linking it to the cached payload %s."
+                                    % (update.product, update.version, sha256))
+                                need_to_dl = False
+                                blob_store.link(sha256, output_filename)
+                                writeHashSidecar(output_filename, sha256)
+                                stats.count('blob_hits')
+                                now = datetime.datetime.utcnow()
+                                recordCachedUpdate(manifest, download_job, sha256=sha256,
+                                                   downloaded=now, last_used=now)
+                            elif blob_key in blob_downloads:
+                                # the same payload is downloaded for another update
+                                L.log(INFO, "Skipping download of %s %s, it will be linked to the download of %s %s."
+                                    % (update.product, update.version,
+                                       blob_downloads[blob_key]['product'], blob_downloads[blob_key]['version']))
+                                need_to_dl = False
+                                blob_downloads[blob_key].setdefault('aliases', []).append(download_job)
+                            else:
+                                blob_downloads[blob_key] = download_job
+                        if need_to_dl:
+                            download_jobs[output_filename] = download_job
+
+
+    stats.startPhase('downloads')
+    failed_downloads = downloadUpdates(
+        sorted(download_jobs.values(), key=lambda job: job['local_path']),
+        concurrency=download_concurrency, show_progress=not opts.no_progressbar,
+        manifest=manifest, blob_store=blob_store)
+    manifest.save()
+    failed_updates = set()
+    for job in failed_downloads:
+        # don't try to import anything we don't have a complete copy of
+        failed_updates.add((job['platform'], job['product'], job['version']))
+        updates = platform_updates[job['platform']]
+        del updates[job['product']][job['version']]
+        if not updates[job['product']]:
+            del updates[job['product']]
     L.log(INFO, "Done caching updates.")
 
     # begin munkiimport run
     if opts.munkiimport:
         L.log(INFO, "Beginning Munki imports..")
+        stats.startPhase('duplicate_checks')
+        # only mac updates are imported
+        updates = platform_updates.get('mac', {})
+        if opts.force_import is False and pref("munki_tool") == "munkiimport":
+            pkginfo_index = PkginfoIndex(munkiimport.REPO_PATH, local_cache_path)
+        import_jobs = []
+        skipped_imports = []
         for (update_name, update_meta) in updates.items():
             for (version_name, version_meta) in update_meta.items():
                 need_to_import = True
@@ -704,33 +2762,27 @@ save a product plist containing every Channel ID found for the product. Plist is
                     pref('munki_pkginfo_name_suffix'))
                 # Do 'exists in repo' checks if we're not forcing imports
                 if opts.force_import is False and pref("munki_tool") == "munkiimport":
-                    pkginfo = munkiimport.makePkgInfo(['--name',
-                                            item_name,
-                                            version_meta['local_path']],
-                                            False)
-                    # Cribbed from munkiimport
+                    # an exact match is a pkginfo with the same
+                    # installer_item_hash, which we have from download time
+                    # rather than having makepkginfo mount and hash the item
                     L.log(VERBOSE, "Looking for a matching pkginfo for %s %s.." % (
                         item_name, version_name))
-                    matchingpkginfo = munkiimport.findMatchingPkginfo(pkginfo)
+                    matchingpkginfo = pkginfo_index.findByHash(getFileHash(version_meta['local_path']))
+                    stats.count('duplicate_checks')
                     if matchingpkginfo:
                         L.log(VERBOSE, "Got a matching pkginfo.")
-                        if ('installer_item_hash' in matchingpkginfo and
-                            matchingpkginfo['installer_item_hash'] ==
-                            pkginfo.get('installer_item_hash')):
-                            need_to_import = False
-                            L.log(INFO,
-                                ("We have an exact match for %s %s in the repo. Skipping.." % (
-                                    item_name, version_name)))
-                    else:
-                        need_to_import = True
+                        need_to_import = False
+                        L.log(INFO,
+                            ("We have an exact match for %s %s in the repo. Skipping.." % (
+                                item_name, version_name)))
 
                 if need_to_import:
                     munkiimport_opts = pref('munkiimport_options')[:]
+                    if 'munki_repo_destination_path' in version_meta.keys():
+                        subdir = version_meta['munki_repo_destination_path']
+                    else:
+                        subdir = pref('munki_repo_destination_path')
                     if pref("munki_tool") == 'munkiimport':
-                        if 'munki_repo_destination_path' in version_meta.keys():
-                            subdir = version_meta['munki_repo_destination_path']
-                        else:
-                            subdir = pref('munki_repo_destination_path')
                         munkiimport_opts.append('--subdirectory')
                         munkiimport_opts.append(subdir)
                     if not version_meta['munki_update_for']:
@@ -757,42 +2809,366 @@ save a product plist containing every Channel ID found for the product. Plist is
                         munkiimport_opts += version_meta['makepkginfo_options']
 
                     if pref('munki_tool') == 'munkiimport':
-                        import_cmd = ['/usr/local/munki/munkiimport', '--nointeractive']
-                    elif pref('munki_tool') == 'makepkginfo':
-                        import_cmd = ['/usr/local/munki/makepkginfo']
+                        import_cmd = [os.path.join(MUNKI_DIR, 'munkiimport'), '--nointeractive']
                     else:
-                        # TODO: validate this pref earlier
-                        L.log(ERROR, "Not sure what tool you wanted to use; munki_tool should be 'munkiimport' " + \
-                        "or 'makepkginfo' but we got '%s'.  Skipping import." % (pref('munki_tool')))
-                        break
+                        import_cmd = [os.path.join(MUNKI_DIR, 'makepkginfo')]
                     # Load our app munkiimport options overrides last
                     import_cmd += munkiimport_opts
                     import_cmd.append(version_meta['local_path'])
 
-                    L.log(INFO, "Importing {0} {1} into Munki. Update for: {2}".format(
-                        item_name, version_name, ', '.join(update_catalogs)))
-                    L.log(VERBOSE, "Calling %s on %s version %s, file %s." % (
-                        pref('munki_tool'),
-                        update_name,
-                        version_name,
-                        version_meta['local_path']))
-                    munkiprocess = subprocess.Popen(import_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    # wait for the process to terminate
-                    stdout, stderr = munkiprocess.communicate()
-                    import_retcode = munkiprocess.returncode
-                    if import_retcode:
-                        L.log(ERROR, "munkiimport returned an error. Skipping update..")
+                    if pref('munki_tool') == 'makepkginfo':
+                        destination = version_meta['local_path']
                     else:
-                        if pref('munki_tool') == 'makepkginfo':
-                            plist_path = os.path.splitext(version_meta['local_path'])[0] + ".plist"
-                            with open(plist_path, "w") as plist:
-                                plist.write(stdout)
-                                L.log(INFO, "pkginfo written to %s" % plist_path)
-
+                        # imports into the same repo subdirectory are run
+                        # one at a time
+                        destination = subdir
+                    import_jobs.append({'item_name': item_name,
+                                        'update_name': update_name,
+                                        'version': version_name,
+                                        'local_path': version_meta['local_path'],
+                                        'update_catalogs': update_catalogs,
+                                        'subdirectory': subdir,
+                                        'destination': destination,
+                                        'cmd': import_cmd})
+                else:
+                    skipped_imports.append((item_name, version_name))
 
+        stats.startPhase('imports')
+        if import_jobs:
+            results = runImportJobs(import_jobs, concurrency=pref('import_concurrency'))
+        else:
+            results = []
         L.log(INFO, "Done Munki imports.")
+        L.log(INFO, "Munki import summary:")
+        for item_name, version_name in skipped_imports:
+            L.log(INFO, "  - %s %s: skipped, already in the repo" % (item_name, version_name))
+        for job in results:
+            if job['returncode']:
+                result = "failed, %s exited with code %s" % (pref('munki_tool'), job['returncode'])
+            else:
+                result = "imported"
+            L.log(INFO, "  - %s %s: %s" % (job['item_name'], job['version'], result))
+            if job['returncode']:
+                failed_updates.add(('mac', job['update_name'], job['version']))
         if opts.make_catalogs:
-            munkiimport.makeCatalogs()
+            stats.startPhase('catalogs')
+            imported = [job for job in results if not job['returncode']]
+            if opts.incremental_catalogs and all(job.get('pkginfo_path') for job in imported):
+                if imported:
+                    L.log(INFO, "Adding %s imported pkginfos to the repo's catalogs.." % len(imported))
+                    try:
+                        updateCatalogs(munkiimport.REPO_PATH, [job['pkginfo_path'] for job in imported])
+                    except (ExpatError, IOError, OSError) as e:
+                        L.log(WARNING, "Warning: Couldn't update catalogs incrementally (%s), "
+                              "rebuilding them instead." % e)
+                        munkiimport.makeCatalogs()
+            else:
+                if opts.incremental_catalogs:
+                    L.log(VERBOSE, "Couldn't determine every imported pkginfo path, rebuilding catalogs.")
+                munkiimport.makeCatalogs()
+
+    # channels whose updates failed to download or import, or whose details
+    # couldn't be retrieved, are left to be processed again by the next
+    # incremental run
+    stats.endPhase()
+    for platform in opts.platform:
+        platform_failed = set((product, version) for (failed_platform, product, version)
+                              in failed_updates if failed_platform == platform)
+        platform_failed.update(key for key, update_details in details[platform].items()
+                               if update_details is None)
+        failed_channels = [c for c in channels if wanted[platform][c] & platform_failed]
+        snapshots[platform].save(channel_digests[platform], wanted[platform], plist_digests,
+                                 options_key, failed_channels)
+    stats.count('failed_updates', len(failed_updates))
+
+    if opts.gc:
+        stats.startPhase('gc')
+        runGarbageCollection(opts, manifest, feed_indexes, wanted)
+        stats.endPhase()
+
+
+def runWithStats(opts, loaded_plists=None):
+    """Calls runAamporter with fresh RunStats, profiling it if --profile was
+    given, and writes out the stats afterwards whether or not it succeeded."""
+    global stats
+    stats = RunStats()
+    profiler = None
+    if opts.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    result = 'failed'
+    try:
+        runAamporter(opts, loaded_plists)
+        result = 'success'
+    finally:
+        stats.finish(result)
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(opts.profile)
+            L.log(VERBOSE, "Profile written to %s" % opts.profile)
+            if L.isEnabledFor(DEBUG):
+                pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(25)
+        if opts.stats_json:
+            stats.writeJSON(opts.stats_json)
+        if opts.stats_prom:
+            stats.writePrometheus(opts.stats_prom)
+
+
+def main():
+    usage = """
+
+%prog [options] path/to/plist [path/to/more/plists..]
+%prog --build-product-plist [path/to/CCP/pkg/file.ccp] [--munki-update-for BaseProductPkginfoName]
+
+The first form will check and cache updates for the channels listed in the product plists
+given as arguments.
+
+The second form will generate a product plist containing all channel IDs contained in the
+installer metadata. Accepts either a path to a .cpp file (from Creative Cloud Packager) or
+a mounted ESD volume path for CS6-and-earlier installers. --build-product-plist may be given
+several times, or a directory of .ccp files, to build a plist for each installer.
+
+See %prog --help for more options and the README for more detail."""
+
+    o = optparse.OptionParser(usage=usage)
+    o.add_option("-l", "--platform", type='choice', choices=['mac', 'win', 'all'], action="append",
+        help=("Download Adobe updates for Mac or Windows. Available options are 'mac', 'win' or 'all', "
+              "defaults to 'mac'. Can be specified multiple times, and feeds for all platforms "
+              "are then fetched in parallel."))
+    o.add_option("-m", "--munkiimport", action="store_true", default=False,
+        help="Process downloaded updates with munkiimport using options defined in %s." % os.path.basename(settings_plist))
+    o.add_option("-r", "--include-revoked", action="store_true", default=False,
+        help="Include updates that have been marked as revoked in Adobe's feed XML.")
+    o.add_option("--skip-cc", action="store_true", default=False,
+        help=("Skip updates for Creative Cloud updates. Useful for certain updates for "
+              "CS-era applications that incorporate CC subscription updates."))
+    o.add_option("-f", "--force-import", action="store_true", default=False,
+        help="Run munkiimport even if it finds an identical pkginfo and installer_item_hash in the repo.")
+    o.add_option("-c", "--make-catalogs", action="store_true", default=False,
+        help="Automatically run makecatalogs after importing into Munki.")
+    o.add_option("--incremental-catalogs", action="store_true", default=False,
+        help=("Implies --make-catalogs. Instead of rebuilding every catalog, add only the pkginfos "
+              "imported in this run to the repo's existing catalogs."))
+    o.add_option("-p", "--product-plist", "--plist", action="append", default=[],
+        help="Deprecated option for specifying product plists, kept for compatibility. Instead, pass plist paths \
+as arguments.")
+    o.add_option("-b", "--build-product-plist", action="append",
+        help="Given a path to either a mounted Adobe product ESD installer or a .ccp file from a package built with CCP, \
+save a product plist containing every Channel ID found for the product. Plist is saved to the current working directory. \
+Can be specified multiple times, or given a directory of .ccp files, to build several plists in parallel.")
+    o.add_option("--merged-product-plist", action="store",
+        help=("To be used with the --build-product-plist option, also save a product plist "
+              "containing the Channel IDs from every installer to this path."))
+    o.add_option("-u", "--munki-update-for", action="store",
+        help="To be used with the --build-product-plist option, specifies the base Munki product.")
+    o.add_option("--verify-cache", action="store_true", default=False,
+        help=("Check every file recorded in the cache manifest against its recorded size and "
+              "SHA-256 hash, then exit."))
+    o.add_option("-v", "--verbose", action="count", default=0,
+        help="Output verbosity. Can be specified either '-v' or '-vv'.")
+    o.add_option("--incremental", action="store_true", default=False,
+        help=("Only process channels whose feed entries or product plists changed since the "
+              "last run."))
+    o.add_option("--changes-only", action="store_true", default=False,
+        help=("Report updates that are new, revoked or superseded since the last run, without "
+              "downloading or importing anything."))
+    o.add_option("--watch", action="store_true", default=False,
+        help=("Keep running, checking the feed for changes every --watch-interval seconds. "
+              "Implies --incremental."))
+    o.add_option("--watch-interval", type='int', default=900,
+        help="Seconds between runs in --watch mode, defaults to 900.")
+    o.add_option("--watch-jitter", type='int', default=60,
+        help="Maximum number of seconds by which to randomly vary --watch-interval, defaults to 60.")
+    o.add_option("--serve", action="store", metavar="[HOST:]PORT",
+        help=("Serve the cached feeds, update details and payloads to other aamporter instances "
+              "on this address, using the URL layout of Adobe's servers. Can be combined with "
+              "--watch to keep the cache up to date while serving it."))
+    o.add_option("--gc", action="store_true", default=False,
+        help=("After the run, list the cached payloads that can be removed: revoked and superseded "
+              "ones, and others as needed to fit the cache_max_size and cache_max_age budgets. "
+              "Payloads wanted by the product plists are always kept."))
+    o.add_option("--gc-only", action="store_true", default=False,
+        help="Like --gc, but without downloading or importing anything first.")
+    o.add_option("--gc-delete", action="store_true", default=False,
+        help="Remove the payloads listed by --gc or --gc-only, rather than only listing them.")
+    o.add_option("--gc-max-size", action="store", metavar="SIZE",
+        help=("Size to shrink the cache to, in bytes or with a K, M, G or T suffix. Overrides the "
+              "cache_max_size setting."))
+    o.add_option("--gc-max-age", type='int', metavar="DAYS",
+        help=("Remove payloads not used by a run for this many days. Overrides the cache_max_age "
+              "setting."))
+    o.add_option("--gc-keep-imported", action="store_true", default=False,
+        help="Never remove payloads that have been imported into the Munki repo. Requires --munkiimport, "
+             "and munki_tool set to 'munkiimport'.")
+    o.add_option("-j", "--jobs", type='int',
+        help="Number of updates to download in parallel. Overrides the download_concurrency setting.")
+    o.add_option("--feed-max-age", type='int',
+        help=("Reuse the cached feed without contacting the server if it was checked less "
+              "than this many seconds ago. Overrides the feed_max_age setting."))
+    o.add_option("--stats-json", action="store",
+        help="Write timings and counters for each phase of the run to this path as JSON.")
+    o.add_option("--stats-prom", action="store",
+        help=("Write timings and counters for each phase of the run to this path in the "
+              "Prometheus text format, for the node exporter's textfile collector."))
+    o.add_option("--profile", action="store",
+        help="Profile the run with cProfile and save the profile data to this path.")
+    o.add_option("--no-colors", action="store_true", default=False,
+        help="Disable colored ANSI output.")
+    o.add_option("--no-progressbar", action="store_true", default=False,
+        help="Disable the download progress indicator.")
+
+    opts, args = o.parse_args()
+
+    # setup logging
+    global L
+    L = logging.getLogger('com.github.aamporter')
+    log_stdout_handler = logging.StreamHandler(stream=sys.stdout)
+    log_stdout_handler.setFormatter(ColorFormatter(
+        use_color=not opts.no_colors))
+    L.addHandler(log_stdout_handler)
+    # INFO is level 30, so each verbose option count lowers level by 10
+    L.setLevel(INFO - (10 * opts.verbose))
+
+    # arg/opt processing
+    if len(sys.argv) == 1:
+        o.print_usage()
+        sys.exit(0)
+
+    try:
+        settings.load()
+    except SettingsError as e:
+        errorExit(str(e))
+
+    # any args we just pass through to the "legacy" --product-plist/--plist options
+    if args:
+        opts.product_plist.extend(args)
+    if opts.munki_update_for and not opts.build_product_plist:
+        errorExit("--munki-update-for requires the --build-product-plist option!")
+    if opts.merged_product_plist and not opts.build_product_plist:
+        errorExit("--merged-product-plist requires the --build-product-plist option!")
+    if opts.serve and opts.product_plist and not opts.watch:
+        errorExit("--serve can only be given product plists along with --watch!")
+    if (not opts.build_product_plist and not opts.product_plist and not opts.verify_cache and
+            not opts.serve):
+        errorExit("One of --product-plist or --build-product-plist must be specified!")
+    if opts.incremental_catalogs:
+        opts.make_catalogs = True
+    if opts.gc_only:
+        opts.gc = True
+    if (opts.gc_delete or opts.gc_max_size or opts.gc_max_age or opts.gc_keep_imported) and not opts.gc:
+        errorExit("The --gc-* options require --gc or --gc-only!")
+    if opts.gc_keep_imported and not opts.munkiimport:
+        errorExit("--gc-keep-imported requires the --munkiimport option!")
+    if opts.gc_keep_imported and pref('munki_tool') != 'munkiimport':
+        errorExit("--gc-keep-imported needs the Munki repo's location from munkiimport, "
+                  "so it can't be used with munki_tool set to '%s'." % pref('munki_tool'))
+    if opts.gc_max_size is not None:
+        try:
+            opts.gc_max_size = parseSize(opts.gc_max_size)
+        except ValueError:
+            errorExit("Couldn't understand the --gc-max-size value: %s" % opts.gc_max_size)
+    platforms = opts.platform or ['mac']
+    if 'all' in platforms:
+        platforms = ['mac', 'win']
+    opts.platform = list(OrderedDict.fromkeys(platforms))
+    if 'mac' not in opts.platform and opts.munkiimport:
+        errorExit("Cannot use the --munkiimport option without the mac platform!")
+
+    if opts.build_product_plist:
+        installer_paths = expandInstallerPaths(opts.build_product_plist)
+        if opts.munki_update_for and len(installer_paths) > 1:
+            errorExit("--munki-update-for can only be used when building a single product plist!")
+        results = buildProductPlists(installer_paths, opts.munki_update_for,
+                                     workers=multiprocessing.cpu_count())
+        failed = 0
+        merged_channels = set()
+        for esd_path, plist, error in results:
+            if error:
+                L.log(ERROR, error)
+                failed += 1
+                continue
+            merged_channels.update(plist['channels'])
+            if opts.munki_update_for:
+                output_plist_name = opts.munki_update_for
+            else:
+                output_plist_name = os.path.basename(esd_path.replace(' ', ''))
+            output_plist_name += '.plist'
+            output_plist_file = os.path.join(os.getcwd(), output_plist_name)
+            if os.path.exists(output_plist_file):
+                L.log(ERROR, "A file already exists at %s, not going to overwrite." %
+                    output_plist_file)
+                failed += 1
+                continue
+            try:
+                plistlib.writePlist(plist, output_plist_file)
+            except:
+                L.log(ERROR, "Error writing plist to %s" % output_plist_file)
+                failed += 1
+                continue
+            print "Product plist written to %s" % output_plist_file
+        if opts.merged_product_plist:
+            if os.path.exists(opts.merged_product_plist):
+                errorExit("A file already exists at %s, not going to overwrite." %
+                    opts.merged_product_plist)
+            try:
+                plistlib.writePlist({'channels': sorted(merged_channels)}, opts.merged_product_plist)
+            except:
+                errorExit("Error writing plist to %s" % opts.merged_product_plist)
+            print "Merged product plist written to %s" % opts.merged_product_plist
+        if failed:
+            errorExit("Couldn't build product plists for %s of %s installers." % (
+                failed, len(results)))
+        sys.exit(0)
+
+    # munki sanity checks
+    if opts.munkiimport:
+        if not os.path.exists('/usr/local/munki'):
+            errorExit("No Munki installation could be found. Get it at http://code.google.com/p/munki")
+        sys.path.insert(0, MUNKI_DIR)
+        munkiimport_prefs = os.path.expanduser('~/Library/Preferences/com.googlecode.munki.munkiimport.plist')
+        if pref('munki_tool') == 'munkiimport':
+            if not os.path.exists(munkiimport_prefs):
+                errorExit("Your Munki repo seems to not be configured. Run munkiimport --configure first.")
+            try:
+                import imp
+                # munkiimport doesn't end in .py, so we use imp to make it available to the import system
+                imp.load_source('munkiimport', os.path.join(MUNKI_DIR, 'munkiimport'))
+                import munkiimport
+                munkiimport.REPO_PATH = munkiimport.pref('repo_path')
+            except ImportError:
+                errorExit("There was an error importing munkilib, which is needed for --munkiimport functionality.")
+
+            # rewrite some of munkiimport's function names since they were changed to
+            # snake case around 2.6.1:
+            # https://github.com/munki/munki/commit/e3948104e869a6a5eb6b440559f4c57144922e71
+            try:
+                munkiimport.repoAvailable()
+            except AttributeError:
+                munkiimport.repoAvailable = munkiimport.repo_available
+                munkiimport.makePkgInfo = munkiimport.make_pkginfo
+                munkiimport.makeCatalogs = munkiimport.make_catalogs
+                munkiimport.copyItemToRepo = munkiimport.copy_item_to_repo
+                munkiimport.copyPkginfoToRepo = munkiimport.copy_pkginfo_to_repo
+
+    local_cache_path = setupCachePath()
+    if opts.verify_cache:
+        failed = verifyCache(CacheManifest(local_cache_path), workers=downloadConcurrency(opts))
+        if failed:
+            errorExit("%s cached files failed verification." % len(failed))
+        L.log(INFO, "All cached files verified.")
+        sys.exit(0)
+
+    if opts.serve:
+        startMirror(local_cache_path, opts.serve)
+        if not opts.watch:
+            while True:
+                time.sleep(3600)
+
+    if opts.watch:
+        watch(opts, local_cache_path)
+    else:
+        runWithStats(opts)
+
 
 if __name__ == '__main__':
     main()
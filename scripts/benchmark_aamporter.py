@@ -0,0 +1,498 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Benchmarks for aamporter that don't touch Adobe's servers.
+#
+# A synthetic updater feed, with matching details XMLs and dummy payloads, is
+# generated into a working directory and served by a local HTTP server that
+# mimics the URL layout of Adobe's update servers. aamporter is pointed at it
+# using the 'aam_server_baseurl' setting, and the following are timed:
+#
+# - feed_fetch_cold:   getFeedData() with an empty feed cache
+# - feed_fetch_304:    getFeedData() revalidating the cached feed
+# - feed_parse:        parseFeedData() over the whole feed
+# - feed_index:        building a FeedIndex
+# - resolve_channels:  resolving the wanted updates of every channel in the feed
+# - details_cold:      fetchUpdateDetails() and addUpdatesXML() with an empty details cache
+# - details_warm:      the same again, answered from the details cache
+# - downloads:         downloadUpdates() of the payloads for the benchmarked channels
+# - munki_import:      runImportJobs() against a stub 'makepkginfo' in a fake MUNKI_DIR
+# - full_run_cold:     a complete aamporter run with an empty cache
+# - full_run_warm:     a complete aamporter run with everything already cached
+#
+# Each benchmark is run --repeat times and the fastest time is kept. Results
+# are appended to a JSON file of past runs (--results), and each timing is
+# compared with the most recent earlier run of the same benchmark with the same
+# parameters, so that regressions show up between changes:
+#
+# ./benchmark_aamporter.py --lines 100000
+# ./benchmark_aamporter.py --lines 1000000 --channels 200 --only feed_parse,feed_index
+
+import hashlib
+import imp
+import json
+import logging
+import optparse
+import os
+import plistlib
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import BaseHTTPServer
+import SocketServer
+
+from multiprocessing import Process
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+AAMPORTER_PATH = os.path.join(os.path.dirname(SCRIPT_DIR), 'aamporter.py')
+PLATFORM = 'mac'
+STUB_MAKEPKGINFO = """#!/bin/sh
+sleep %(delay)s
+cat <<EOF
+<?xml version="1.0" encoding="UTF-8"?>
+<plist version="1.0"><dict><key>name</key><string>stub</string></dict></plist>
+EOF
+"""
+BENCHMARKS = ['feed_fetch_cold', 'feed_fetch_304', 'feed_parse', 'feed_index',
+              'resolve_channels', 'details_cold', 'details_warm', 'downloads',
+              'munki_import', 'full_run_cold', 'full_run_warm']
+
+
+def generateFeed(root, lines, num_channels, payload_size, seed):
+    """Writes a synthetic updater feed of roughly 'lines' entries, with the
+    details XMLs and payloads for the first num_channels of its channels, to
+    root in the layout of Adobe's update servers. Returns the list of those
+    channels."""
+    rand = random.Random(seed)
+    num_products = max(10, lines // 100)
+    products = ['Product%05d' % i for i in range(num_products)]
+    versions = {}
+    for product in products:
+        major = rand.randint(1, 20)
+        versions[product] = ['%d.%d.%d' % (major, minor, rand.randint(0, 300))
+                             for minor in range(rand.randint(2, 10))]
+    channels = ['Channel%06d' % i for i in range(max(num_channels, lines // 20))]
+    # each channel gets updates for a few products, as base product channels
+    # share updates for components like CSXS Infrastructure
+    channel_products = dict((c, rand.sample(products, min(len(products), rand.randint(1, 4))))
+                            for c in channels)
+
+    feed_dir = os.path.join(root, 'webfeed', 'oobe', 'aam20', PLATFORM)
+    os.makedirs(feed_dir)
+    with open(os.path.join(feed_dir, 'updaterfeed.xml'), 'w') as feed:
+        for i in range(lines):
+            channel = channels[i % len(channels)]
+            product = rand.choice(channel_products[channel])
+            version = rand.choice(versions[product])
+            kind = rand.random()
+            if kind < 0.05:
+                other = rand.choice(products)
+                feed.write('<COMBO,%s,%s,%s,%s,%s>\n' % (
+                    channel, product, version, other, rand.choice(versions[other])))
+            elif kind < 0.08:
+                feed.write('<REVOKE,ALL,%s,%s>\n' % (product, version))
+            elif kind < 0.15:
+                feed.write('<REVOKE,%s,%s,%s>\n' % (channel, product, version))
+            else:
+                feed.write('<%s,%s,%s>\n' % (channel, product, version))
+
+    wanted_channels = channels[:num_channels]
+    payload = os.urandom(payload_size)
+    for product in set(p for c in wanted_channels for p in channel_products[c]):
+        for version in versions[product]:
+            # leave some details missing, as happens in Adobe's feed
+            if rand.random() < 0.02:
+                continue
+            update_dir = os.path.join(root, 'updates', 'oobe', 'aam20', PLATFORM, product, version)
+            os.makedirs(update_dir)
+            filename = '%s-%s.dmg' % (product, version)
+            with open(os.path.join(update_dir, '%s.xml' % version), 'w') as details:
+                details.write(
+                    '<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<UpdateDetails><TargetLicensingType>2</TargetLicensingType>'
+                    '<DisplayName><en_US>%s %s</en_US></DisplayName>'
+                    '<Description><en_US>Synthetic update %s %s</en_US></Description>'
+                    '<InstallFiles><File><Name>%s</Name><Size>%d</Size></File></InstallFiles>'
+                    '</UpdateDetails>\n' % (product, version, product, version, filename, payload_size))
+            with open(os.path.join(update_dir, filename), 'wb') as f:
+                f.write(payload)
+    return wanted_channels
+
+
+class AdobeServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves files under the server's root with keep-alive connections,
+    ETag revalidation and single byte-range requests, which is all of
+    Adobe's server behaviour that aamporter relies on."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = os.path.join(self.server.root, self.path.split('?')[0].lstrip('/'))
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        st = os.stat(path)
+        etag = '"%x-%x"' % (st.st_size, int(st.st_mtime))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = 0, st.st_size - 1
+        byte_range = self.headers.get('Range')
+        if byte_range and byte_range.startswith('bytes='):
+            first, last = byte_range[6:].split('-', 1)
+            start = int(first)
+            if last:
+                end = min(int(last), end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, st.st_size))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def log_message(self, *args):
+        pass
+
+
+class AdobeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), AdobeServerHandler)
+        self.root = root
+
+
+def startServer(root):
+    """Starts an AdobeServer for root in a separate process, so that it
+    doesn't compete with the benchmarks for the GIL. Returns the process and
+    the server's base URL."""
+    server = AdobeServer(root)
+    process = Process(target=server.serve_forever)
+    process.daemon = True
+    process.start()
+    server.socket.close()
+    return process, 'http://127.0.0.1:%d/' % server.server_address[1]
+
+
+def loadAamporter(work_dir):
+    """Imports aamporter.py as a module configured to use the settings plist
+    in work_dir, with its logging silenced."""
+    aam = imp.load_source('aamporter', AAMPORTER_PATH)
+    aam.L = logging.getLogger('com.github.aamporter.benchmark')
+    aam.L.addHandler(logging.NullHandler())
+    aam.L.setLevel(aam.ERROR + 1)
+    aam.settings = aam.Settings(os.path.join(work_dir, 'aamporter.plist'))
+    return aam
+
+
+class Benchmarks(object):
+    def __init__(self, aam, work_dir, channels, opts):
+        self.aam = aam
+        self.work_dir = work_dir
+        self.cache_path = aam.pref('local_cache_path')
+        self.channels = channels
+        self.opts = opts
+        self.tokens = None
+        self.parsed = None
+        self.feed_index = None
+        self.candidates = None
+        self.download_jobs = None
+
+    def resetCache(self, keep_feed=False):
+        for name in os.listdir(self.cache_path):
+            if keep_feed and name == 'feeds':
+                continue
+            path = os.path.join(self.cache_path, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def run(self, name):
+        """Returns the fastest of --repeat timings of a benchmark, in seconds."""
+        timings = []
+        for _ in range(self.opts.repeat):
+            setup = getattr(self, 'setup_' + name, None)
+            if setup:
+                setup()
+            start = time.time()
+            getattr(self, 'bench_' + name)()
+            timings.append(time.time() - start)
+        return min(timings)
+
+    def setup_feed_fetch_cold(self):
+        self.resetCache()
+
+    def bench_feed_fetch_cold(self):
+        self.tokens = list(self.aam.getFeedData(PLATFORM))
+
+    def setup_feed_fetch_304(self):
+        if not os.path.exists(self.aam.getFeedCachePaths(PLATFORM)[0]):
+            list(self.aam.getFeedData(PLATFORM))
+
+    def bench_feed_fetch_304(self):
+        self.tokens = list(self.aam.getFeedData(PLATFORM))
+
+    def setup_feed_parse(self):
+        if self.tokens is None:
+            self.tokens = list(self.aam.getFeedData(PLATFORM))
+
+    def bench_feed_parse(self):
+        self.parsed = list(self.aam.parseFeedData(self.tokens))
+
+    def setup_feed_index(self):
+        if self.parsed is None:
+            self.setup_feed_parse()
+            self.bench_feed_parse()
+
+    def bench_feed_index(self):
+        self.feed_index = self.aam.FeedIndex(self.parsed)
+
+    def setup_resolve_channels(self):
+        if self.feed_index is None:
+            self.setup_feed_index()
+            self.bench_feed_index()
+
+    def bench_resolve_channels(self):
+        for channel in self.feed_index.channels:
+            self.aam.resolveWantedUpdates(self.feed_index, channel)
+
+    def setup_details_cold(self):
+        self.setup_resolve_channels()
+        self.candidates = []
+        for channel in self.channels:
+            updates = self.feed_index.channels.get(channel, [])
+            highest = self.aam.getHighestVersionsOfProducts(updates)
+            self.candidates.extend(u for u in updates
+                                   if not u.revoked and highest.get(u.product) == u.version)
+        self.resetCache(keep_feed=True)
+
+    def fetchDetails(self):
+        aam = self.aam
+        details_cache = aam.DetailsCache(os.path.join(self.cache_path, 'details.db'),
+                                         aam.pref('details_negative_ttl'))
+        try:
+            details = aam.fetchUpdateDetails(
+                [(u.product, u.version) for u in self.candidates], PLATFORM, details_cache,
+                workers=aam.pref('details_fetch_concurrency'))
+            return aam.addUpdatesXML(self.candidates, PLATFORM, details_cache=details_cache,
+                                     details=details)
+        finally:
+            details_cache.close()
+
+    def bench_details_cold(self):
+        self.fetchDetails()
+
+    def setup_details_warm(self):
+        if self.candidates is None:
+            self.setup_details_cold()
+        self.fetchDetails()
+
+    def bench_details_warm(self):
+        self.fetchDetails()
+
+    def setup_downloads(self):
+        if self.candidates is None:
+            self.setup_details_cold()
+        base_url = self.aam.pref('aam_server_baseurl')
+        self.download_jobs = {}
+        for update in self.fetchDetails():
+            local_path = os.path.join(self.cache_path, '%s-%s.dmg' % (update.product, update.version))
+            self.download_jobs[local_path] = {
+                'product': update.product,
+                'version': update.version,
+                'platform': PLATFORM,
+                'url': '%s%s%s/%s/%s/%s' % (base_url, self.aam.UPDATE_PATH_PREFIX, PLATFORM,
+                                           update.product, update.version, update.details.file_name),
+                'local_path': local_path,
+                'size': int(update.details.file_size)}
+            if os.path.exists(local_path):
+                os.remove(local_path)
+        manifest_path = os.path.join(self.cache_path, 'manifest.plist')
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+    def bench_downloads(self):
+        manifest = self.aam.CacheManifest(self.cache_path)
+        failed = self.aam.downloadUpdates(
+            sorted(self.download_jobs.values(), key=lambda job: job['local_path']),
+            concurrency=self.aam.pref('download_concurrency'), show_progress=False,
+            manifest=manifest)
+        manifest.save()
+        if failed:
+            raise Exception("%s downloads failed" % len(failed))
+
+    def setup_munki_import(self):
+        if self.download_jobs is None:
+            self.setup_downloads()
+            self.bench_downloads()
+        munki_dir = os.path.join(self.work_dir, 'munki')
+        if not os.path.isdir(munki_dir):
+            os.mkdir(munki_dir)
+        makepkginfo = os.path.join(munki_dir, 'makepkginfo')
+        with open(makepkginfo, 'w') as f:
+            f.write(STUB_MAKEPKGINFO % {'delay': self.opts.munki_delay})
+        os.chmod(makepkginfo, 0755)
+        self.aam.MUNKI_DIR = munki_dir
+        self.import_jobs = [{
+            'item_name': '%s_Update' % job['product'],
+            'update_name': job['product'],
+            'version': job['version'],
+            'local_path': job['local_path'],
+            'update_catalogs': [],
+            'subdirectory': 'apps/Adobe',
+            'destination': os.path.join('apps/Adobe', '%s_Update' % job['product']),
+            'cmd': [makepkginfo, job['local_path']]}
+            for job in self.download_jobs.values()]
+
+    def bench_munki_import(self):
+        self.aam.settings.values['munki_tool'] = 'makepkginfo'
+        try:
+            self.aam.runImportJobs(self.import_jobs, concurrency=self.aam.pref('import_concurrency'))
+        finally:
+            del self.aam.settings.values['munki_tool']
+
+    def runAamporter(self):
+        # aamporter reads aamporter.plist from the directory it is run from,
+        # so it is run through a symlink in the working directory
+        subprocess.check_call([sys.executable, os.path.join(self.work_dir, 'aamporter.py'),
+                               '--no-progressbar', '--no-colors',
+                               os.path.join(self.work_dir, 'product.plist')],
+                              stdout=open(os.devnull, 'w'))
+
+    def setup_full_run_cold(self):
+        self.resetCache()
+
+    def bench_full_run_cold(self):
+        self.runAamporter()
+
+    def setup_full_run_warm(self):
+        self.runAamporter()
+
+    def bench_full_run_warm(self):
+        self.runAamporter()
+
+
+def compareResults(history, results, threshold):
+    """Prints each benchmark's time alongside that of the most recent run in
+    history with the same parameters, flagging those that got slower by more
+    than threshold. Returns the number of regressions."""
+    regressions = 0
+    for name in BENCHMARKS:
+        if name not in results['timings']:
+            continue
+        timing = results['timings'][name]
+        line = "%-18s %9.3fs" % (name, timing)
+        before = None
+        for previous in reversed(history):
+            if previous['parameters'] == results['parameters'] and name in previous['timings']:
+                before = previous['timings'][name]
+                break
+        if before:
+            change = (timing - before) / before
+            line += "  (was %.3fs, %+.1f%%)" % (before, change * 100)
+            if change > threshold:
+                line += "  REGRESSION"
+                regressions += 1
+        print line
+    return regressions
+
+
+def main():
+    o = optparse.OptionParser(usage="%prog [options]")
+    o.add_option("--lines", type='int', default=100000,
+        help="Number of entries in the synthetic feed. Defaults to 100000.")
+    o.add_option("--channels", type='int', default=50,
+        help="Number of channels to fetch details and payloads for. Defaults to 50.")
+    o.add_option("--payload-size", type='int', default=1024 * 1024,
+        help="Size in bytes of each dummy payload. Defaults to 1 MB.")
+    o.add_option("--munki-delay", type='float', default=0.05,
+        help="Seconds the stub makepkginfo takes per import. Defaults to 0.05.")
+    o.add_option("--seed", type='int', default=1,
+        help="Random seed for the synthetic feed. Defaults to 1.")
+    o.add_option("--repeat", type='int', default=3,
+        help="Times to run each benchmark, keeping the fastest. Defaults to 3.")
+    o.add_option("--only", action="store",
+        help="Comma-separated list of benchmarks to run. Available: %s." % ', '.join(BENCHMARKS))
+    o.add_option("--results", default="bench_results.json",
+        help="Path of the JSON file of past results to compare with and add this run to. "
+             "Defaults to bench_results.json.")
+    o.add_option("--threshold", type='float', default=0.1,
+        help="Fraction by which a benchmark must slow down to be reported as a regression. "
+             "Defaults to 0.1.")
+    o.add_option("--keep", action="store_true", default=False,
+        help="Don't remove the working directory with the generated feed and cache.")
+    opts, args = o.parse_args()
+
+    names = BENCHMARKS
+    if opts.only:
+        names = opts.only.split(',')
+        for name in names:
+            if name not in BENCHMARKS:
+                sys.exit("Unknown benchmark: %s" % name)
+
+    work_dir = tempfile.mkdtemp(prefix='aamporter-benchmark-')
+    server_root = os.path.join(work_dir, 'server')
+    print "Generating a feed of %s entries in %s.." % (opts.lines, work_dir)
+    channels = generateFeed(server_root, opts.lines, opts.channels, opts.payload_size, opts.seed)
+    server, base_url = startServer(server_root)
+    try:
+        cache_path = os.path.join(work_dir, 'cache')
+        os.mkdir(cache_path)
+        plistlib.writePlist({'aam_server_baseurl': base_url,
+                             'local_cache_path': cache_path},
+                            os.path.join(work_dir, 'aamporter.plist'))
+        plistlib.writePlist({'channels': channels}, os.path.join(work_dir, 'product.plist'))
+        os.symlink(AAMPORTER_PATH, os.path.join(work_dir, 'aamporter.py'))
+
+        aam = loadAamporter(work_dir)
+        benchmarks = Benchmarks(aam, work_dir, channels, opts)
+        results = {'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                   'parameters': {'lines': opts.lines,
+                                  'channels': opts.channels,
+                                  'payload_size': opts.payload_size,
+                                  'munki_delay': opts.munki_delay,
+                                  'seed': opts.seed},
+                   'timings': {}}
+        with open(AAMPORTER_PATH, 'rb') as f:
+            results['aamporter_sha1'] = hashlib.sha1(f.read()).hexdigest()
+        for name in names:
+            print "Running %s.." % name
+            results['timings'][name] = benchmarks.run(name)
+    finally:
+        server.terminate()
+        if not opts.keep:
+            shutil.rmtree(work_dir)
+
+    history = []
+    if os.path.exists(opts.results):
+        with open(opts.results) as f:
+            history = json.load(f)['runs']
+    regressions = compareResults(history, results, opts.threshold)
+    history.append(results)
+    with open(opts.results, 'w') as f:
+        json.dump({'runs': history}, f, indent=2, sort_keys=True)
+    print "Results saved to %s" % opts.results
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
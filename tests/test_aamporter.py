@@ -0,0 +1,347 @@
+#!/usr/bin/python
+#
+# Tests for aamporter that don't touch Adobe's servers. Run with:
+#
+# python -m unittest discover tests
+
+import datetime
+import hashlib
+import imp
+import logging
+import os
+import plistlib
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SimpleHTTPServer
+
+AAMPORTER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'aamporter.py')
+aamporter = imp.load_source('aamporter', AAMPORTER_PATH)
+aamporter.L = logging.getLogger('com.github.aamporter.tests')
+aamporter.L.addHandler(logging.NullHandler())
+
+
+class QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadIntoBlobLinkTest(unittest.TestCase):
+    """A payload name linked to a blob of the 'content' cache_layout must be
+    downloaded afresh, never resumed into, as that would change the blob for
+    every other name linked to it."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.serve_dir = os.path.join(self.tmp, 'srv')
+        os.mkdir(self.serve_dir)
+        self.cache_path = os.path.join(self.tmp, 'cache')
+        os.mkdir(self.cache_path)
+        self.payload = 'B' * 2000
+        with open(os.path.join(self.serve_dir, 'Product-2.0.dmg'), 'wb') as f:
+            f.write(self.payload)
+
+        self.blob_data = 'A' * 1000
+        self.blob_digest = hashlib.sha256(self.blob_data).hexdigest()
+        self.blob_store = aamporter.BlobStore(aamporter.CacheManifest(self.cache_path))
+        os.makedirs(os.path.dirname(self.blob_store.blobPath(self.blob_digest)))
+        with open(self.blob_store.blobPath(self.blob_digest), 'wb') as f:
+            f.write(self.blob_data)
+
+        cwd = os.getcwd()
+        os.chdir(self.serve_dir)
+        self.addCleanup(os.chdir, cwd)
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), QuietHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def downloadTo(self, local_path):
+        job = {'product': 'Product',
+               'version': '2.0',
+               'url': 'http://127.0.0.1:%s/Product-2.0.dmg' % self.server.server_address[1],
+               'local_path': local_path,
+               'size': len(self.payload)}
+        progress = aamporter.DownloadProgress(1, job['size'], enabled=False)
+        self.assertEqual(aamporter.downloadFile(job, progress), None)
+        return job
+
+    def assertBlobIntact(self):
+        with open(self.blob_store.blobPath(self.blob_digest), 'rb') as f:
+            self.assertEqual(f.read(), self.blob_data)
+
+    def testHardLink(self):
+        local_path = os.path.join(self.cache_path, 'Product-2.0.dmg')
+        other_path = os.path.join(self.cache_path, 'Other-1.0.dmg')
+        os.link(self.blob_store.blobPath(self.blob_digest), local_path)
+        os.link(self.blob_store.blobPath(self.blob_digest), other_path)
+        job = self.downloadTo(local_path)
+
+        self.assertBlobIntact()
+        with open(other_path, 'rb') as f:
+            self.assertEqual(f.read(), self.blob_data)
+        with open(local_path, 'rb') as f:
+            self.assertEqual(f.read(), self.payload)
+        self.assertFalse(self.blob_store.isStored(local_path, self.blob_digest))
+        self.assertEqual(job['sha256'], hashlib.sha256(self.payload).hexdigest())
+
+    def testSymlink(self):
+        local_path = os.path.join(self.cache_path, 'Product-2.0.dmg')
+        os.symlink(self.blob_store.blobPath(self.blob_digest), local_path)
+        self.downloadTo(local_path)
+
+        self.assertBlobIntact()
+        self.assertFalse(os.path.islink(local_path))
+        with open(local_path, 'rb') as f:
+            self.assertEqual(f.read(), self.payload)
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the server's payload, answering range requests as the server's
+    range_mode says: 'honor' them, respond with a 206 for the 'wrong' range,
+    or with a '416'. The Range header of each request is recorded."""
+    def do_GET(self):
+        payload = self.server.payload
+        requested = self.headers.get('Range')
+        self.server.ranges.append(requested)
+        if requested and self.server.range_mode == '416':
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % len(payload))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if requested:
+            offset = int(requested[len('bytes='):].rstrip('-'))
+            if self.server.range_mode == 'wrong':
+                offset = 0
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (offset, len(payload) - 1, len(payload)))
+            payload = payload[offset:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ResumeDownloadTest(unittest.TestCase):
+    """A '.part' file left by an interrupted download is resumed, or, if the
+    server can't resume it, discarded and downloaded again from the start."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.local_path = os.path.join(self.tmp, 'Product-2.0.dmg')
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.payload = ''.join(chr(i % 251) for i in range(5000))
+        self.server.ranges = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def download(self, partial_data):
+        with open(self.local_path + '.part', 'wb') as f:
+            f.write(partial_data)
+        job = {'product': 'Product',
+               'version': '2.0',
+               'url': 'http://127.0.0.1:%s/Product-2.0.dmg' % self.server.server_address[1],
+               'local_path': self.local_path,
+               'size': len(self.server.payload)}
+        progress = aamporter.DownloadProgress(1, job['size'], enabled=False)
+        self.assertEqual(aamporter.downloadFile(job, progress), None)
+        with open(self.local_path, 'rb') as f:
+            self.assertEqual(f.read(), self.server.payload)
+        self.assertEqual(job['sha256'], hashlib.sha256(self.server.payload).hexdigest())
+        self.assertFalse(os.path.exists(self.local_path + '.part'))
+
+    def testResume(self):
+        self.server.range_mode = 'honor'
+        self.download(self.server.payload[:2000])
+        self.assertEqual(self.server.ranges, ['bytes=2000-'])
+
+    def testWrongRangeStartsAgain(self):
+        self.server.range_mode = 'wrong'
+        self.download('x' * 2000)
+        self.assertEqual(self.server.ranges, ['bytes=2000-', None])
+
+    def test416StartsAgain(self):
+        self.server.range_mode = '416'
+        self.download('x' * 2000)
+        self.assertEqual(self.server.ranges, ['bytes=2000-', None])
+
+
+class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Responds to every request for a details XML with the HTTP status in
+    its product name, e.g. 503 for /.../Status503/1.0/1.0.xml."""
+    def do_GET(self):
+        status = int(self.path.split('/')[-3][len('Status'):])
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadUpdateDetailsErrorTest(unittest.TestCase):
+    """Only a missing details XML is worth caching as a failure; server
+    errors and rate limiting are retried."""
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StatusHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.saved_values = aamporter.settings.values
+        aamporter.settings.values = {
+            'aam_server_baseurl': 'http://127.0.0.1:%s/' % self.server.server_address[1]}
+
+    def tearDown(self):
+        aamporter.settings.values = self.saved_values
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testStatuses(self):
+        for status, expected in ((404, 'http_404'), (410, 'http_410'),
+                                 (429, None), (500, None), (502, None), (503, None)):
+            result = aamporter.downloadUpdateDetails('Status%s' % status, '1.0', 'mac')
+            self.assertEqual(result, (expected, None), status)
+
+
+class CountingHandler(QuietHandler):
+    def do_GET(self):
+        self.server.requests += 1
+        SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+
+class FeedCacheTest(unittest.TestCase):
+    """A cached feed is only reused without contacting the server if it was
+    checked less than max_age seconds ago."""
+    feed = '<Chan,Product,1.0>\n<Chan,Product,2.0>\n'
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        serve_dir = os.path.join(self.tmp, 'srv')
+        feed_dir = os.path.join(serve_dir, 'webfeed', 'oobe', 'aam20', 'mac')
+        os.makedirs(feed_dir)
+        with open(os.path.join(feed_dir, 'updaterfeed.xml'), 'wb') as f:
+            f.write(self.feed)
+
+        cwd = os.getcwd()
+        os.chdir(serve_dir)
+        self.addCleanup(os.chdir, cwd)
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), CountingHandler)
+        self.server.requests = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.saved_values = aamporter.settings.values
+        aamporter.settings.values = {
+            'aam_server_baseurl': 'http://127.0.0.1:%s/' % self.server.server_address[1],
+            'local_cache_path': os.path.join(self.tmp, 'cache')}
+
+    def tearDown(self):
+        aamporter.settings.values = self.saved_values
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def getFeed(self):
+        return list(aamporter.getFeedData('mac', max_age=3600))
+
+    def testCached(self):
+        self.assertEqual(self.getFeed(), ['Chan,Product,1.0', 'Chan,Product,2.0'])
+        self.assertEqual(self.getFeed(), ['Chan,Product,1.0', 'Chan,Product,2.0'])
+        self.assertEqual(self.server.requests, 1)
+
+    def testMissingCheckedIsStale(self):
+        self.getFeed()
+        meta_path = aamporter.getFeedCachePaths('mac')[1]
+        meta = plistlib.readPlist(meta_path)
+        del meta['checked']
+        plistlib.writePlist(meta, meta_path)
+        self.assertEqual(self.getFeed(), ['Chan,Product,1.0', 'Chan,Product,2.0'])
+        self.assertEqual(self.server.requests, 2)
+        self.assertTrue('checked' in plistlib.readPlist(meta_path))
+
+
+class CollectGarbageTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.manifest = aamporter.CacheManifest(self.cache_path)
+        now = datetime.datetime.utcnow()
+        for filename, last_used in (('Product-1.0.dmg', now),
+                                    ('Product-2.0.dmg', now - datetime.timedelta(days=30)),
+                                    ('Other-1.0.dmg', now - datetime.timedelta(days=30)),
+                                    ('Other-2.0.dmg', now)):
+            with open(self.manifest.localPath(filename), 'wb') as f:
+                f.write('x' * 100)
+            self.manifest.record(filename, platform='mac', last_used=last_used)
+        feed = ['Chan,Product,1.0', 'Chan,Product,2.0', 'Chan,Other,1.0', 'Chan,Other,2.0']
+        self.feed_indexes = {'mac': aamporter.FeedIndex(aamporter.parseFeedData(feed))}
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path)
+
+    def evicted(self, **kwargs):
+        wanted = {'mac': set([('Product', '2.0')])}
+        return sorted(filename for filename, reason in aamporter.collectGarbage(
+            self.manifest, self.feed_indexes, wanted, **kwargs))
+
+    def testNoBudget(self):
+        self.assertEqual(self.evicted(), ['Other-1.0.dmg', 'Product-1.0.dmg'])
+
+    def testMaxAge(self):
+        # superseded payloads are removed whatever their age, and the rest
+        # once they are older than max_age; wanted ones never are
+        self.assertEqual(self.evicted(max_age=10),
+                         ['Other-1.0.dmg', 'Product-1.0.dmg'])
+        self.assertEqual(self.evicted(max_age=60),
+                         ['Other-1.0.dmg', 'Product-1.0.dmg'])
+
+    def testMaxAgeEvictsUnwanted(self):
+        self.manifest.record('Other-2.0.dmg',
+                             last_used=datetime.datetime.utcnow() - datetime.timedelta(days=30))
+        self.assertEqual(self.evicted(max_age=10),
+                         ['Other-1.0.dmg', 'Other-2.0.dmg', 'Product-1.0.dmg'])
+
+    def testMaxSize(self):
+        # only as much as is needed to fit, superseded payloads first
+        self.assertEqual(self.evicted(max_size=300), ['Other-1.0.dmg'])
+
+    def testBlobs(self):
+        # a blob left without links, and the blob of an evicted payload, are
+        # removed whatever the cache_layout
+        blob_store = aamporter.BlobStore(self.manifest)
+        path = self.manifest.localPath('Product-1.0.dmg')
+        blob_store.add(path, aamporter.hashFile(path))
+        orphan_path = blob_store.blobPath('0' * 64)
+        os.makedirs(os.path.dirname(orphan_path))
+        with open(orphan_path, 'wb') as f:
+            f.write('x' * 100)
+        # the unlinked blob counts towards the size, and removing it is enough
+        self.assertEqual(self.evicted(max_size=400, blob_store=blob_store), [])
+        self.assertEqual(self.evicted(max_size=300, blob_store=blob_store), ['Other-1.0.dmg'])
+        self.evicted(blob_store=blob_store, delete=True)
+        self.assertEqual(blob_store.unlinkedBlobs(), [])
+        self.assertEqual(os.listdir(blob_store.path), [])
+
+    def testDelete(self):
+        self.evicted(delete=True)
+        self.assertEqual(sorted(os.listdir(self.cache_path)),
+                         ['Other-2.0.dmg', 'Product-2.0.dmg', 'manifest.plist'])
+
+
+if __name__ == '__main__':
+    unittest.main()